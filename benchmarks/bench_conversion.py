@@ -0,0 +1,196 @@
+## Benchmark the stages of the OPM -> BIDS conversion on synthetic recordings.
+# Harrison Ritz (2025)
+#
+# RUN: $ python benchmarks/bench_conversion.py --channels 64 128 --runs 1 5 --out results.json
+#      $ python benchmarks/bench_conversion.py --source-format double --precision source single short
+#
+# Every combination of the grid arguments is generated with synthetic_opm.make_session, converted stage by
+# stage with the functions of src/opm_format_bids.py, and timed (wall and CPU time) and profiled (peak traced
+# memory). Results are written as JSON so that runs on different versions can be compared.
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import itertools
+import platform
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+
+import mne
+import mne_bids
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import opm_format_bids  # noqa: E402
+from synthetic_opm import make_session  # noqa: E402
+
+
+# %% measurement --------------------------------------------------------------
+
+@contextmanager
+def measure(stages, name):
+    """Records wall time, CPU time and peak traced memory of the enclosed block in stages[name]."""
+
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        stages[name] = {
+            "wall_s": time.perf_counter() - wall,
+            "cpu_s": time.process_time() - cpu,
+            "peak_mb": tracemalloc.get_traced_memory()[1] / 1e6,
+        }
+        tracemalloc.stop()
+
+
+
+
+def _dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, fn)) for root, _, fns in os.walk(path) for fn in fns)
+
+
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# %% benchmark ----------------------------------------------------------------
+
+def run_case(workdir, n_channels, sfreq, duration, n_runs, trigger_rate, anat=False, end_to_end=True,
+             source_format="single", precision=None):
+    """
+    Generates one synthetic session and times each conversion stage: run read, event finding, concatenation,
+    annotation rename, empty room and task BIDS writes, anat write and (optionally) the full bids_conversion.
+    The recordings are stored in `source_format` and written in cfg.output.precision = `precision`.
+    Returns:
+        dict: The case parameters, input/output sizes and per-stage measurements.
+    """
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    cfg = opm_format_bids.BidsConfig.from_dict(make_session(workdir, n_runs=n_runs, n_channels=n_channels, sfreq=sfreq,
+                                                            duration=duration, trigger_rate=trigger_rate, anat=anat,
+                                                            fmt=source_format))
+    cfg.output.precision = precision
+    cfg.validate()
+    subj, session = cfg.session.ids, cfg.session.session
+    stages = dict()
+
+    with measure(stages, "read"):
+        raw_list = [opm_format_bids._load_run(cfg, rr, run) for rr, run in enumerate(cfg.session.run_prefix)]
+
+    with measure(stages, "events"):
+        for rr, raw in enumerate(raw_list):
+            stim_channels = list(dict.fromkeys(cfg.trigger.stim_id[rr]))
+            stim_data = opm_format_bids._read_stim_data(raw, stim_channels, cfg.output.buffer_size_sec)
+            opm_format_bids.decode_triggers(
+                stim_data, raw.first_samp,
+                stim_rows=[stim_channels.index(stim) for stim in cfg.trigger.stim_id[rr]],
+                old_ids=cfg.trigger.old_trigger_id[rr],
+                new_ids=cfg.trigger.new_trigger_id[rr],
+                min_samples=0.001 * raw.info["sfreq"],
+            )
+
+    with measure(stages, "concatenate"):
+        all_raw = mne.concatenate_raws(raw_list, preload=False, on_mismatch="raise")
+
+    with measure(stages, "rename"):
+        opm_format_bids.rename_annotations(all_raw.annotations, cfg.trigger.event_desc)
+
+    emptyroom_bids_path = mne_bids.BIDSPath(subject=f"{subj:03}", session=session, task="noise", datatype="meg",
+                                            root=cfg.dirs.bids_dir)
+    with measure(stages, "emptyroom_write"):
+        opm_format_bids._write_meg_bids(opm_format_bids._load_emptyroom(cfg), emptyroom_bids_path, cfg)
+
+    bids_path = mne_bids.BIDSPath(subject=f"{subj:03}", session=session, task=cfg.session.task, run="01",
+                                  root=cfg.dirs.bids_dir)
+    with measure(stages, "bids_write"):
+        opm_format_bids._write_meg_bids(all_raw, bids_path, cfg, empty_room=emptyroom_bids_path)
+
+    if anat:
+        anat_bids_path = mne_bids.BIDSPath(subject=f"{subj:03}", session=session, suffix="T1w",
+                                           root=cfg.dirs.bids_dir)
+        with measure(stages, "anat_write"):
+            mne_bids.write_anat(image=cfg.dirs.anat_path, bids_path=anat_bids_path, overwrite=True)
+
+    output_bytes = _dir_bytes(cfg.dirs.bids_dir)
+
+    if end_to_end:
+        shutil.rmtree(cfg.dirs.bids_dir)
+        with measure(stages, "bids_conversion"):
+            opm_format_bids.bids_conversion(cfg, force=True)
+
+    return {
+        "params": {"n_channels": n_channels, "sfreq": sfreq, "duration": duration, "n_runs": n_runs,
+                   "trigger_rate": trigger_rate, "anat": anat, "source_format": source_format,
+                   "precision": precision},
+        "input_bytes": _dir_bytes(os.path.join(workdir, "raw")),
+        "output_bytes": output_bytes,
+        "stages": stages,
+    }
+
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the OPM -> BIDS conversion on synthetic data.")
+    parser.add_argument("--channels", type=int, nargs="+", default=[64], help="number of OPM channels")
+    parser.add_argument("--sfreq", type=float, nargs="+", default=[1000.0], help="sampling rate (Hz)")
+    parser.add_argument("--duration", type=float, nargs="+", default=[60.0], help="duration of each run (s)")
+    parser.add_argument("--runs", type=int, nargs="+", default=[5], help="number of runs per session")
+    parser.add_argument("--trigger-rate", type=float, nargs="+", default=[1.0], help="triggers per second")
+    parser.add_argument("--source-format", choices=["single", "double"], default="single",
+                        help="sample format of the synthetic recordings")
+    parser.add_argument("--precision", nargs="+", choices=["source", "single", "double", "short"], default=["source"],
+                        help="output.precision of the conversion (source: keep the format of the recordings)")
+    parser.add_argument("--anat", action="store_true", help="also time the T1w write (requires nibabel)")
+    parser.add_argument("--no-end-to-end", action="store_true", help="skip timing the full bids_conversion")
+    parser.add_argument("--workdir", default=os.path.join(os.getcwd(), "bench_data"),
+                        help="scratch directory for the synthetic data (deleted afterwards)")
+    parser.add_argument("--out", default="bench_conversion.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    mne.set_log_level("error")
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "versions": {"python": platform.python_version(), "mne": mne.__version__, "mne_bids": mne_bids.__version__},
+        "cases": list(),
+    }
+
+    grid = itertools.product(args.channels, args.sfreq, args.duration, args.runs, args.trigger_rate, args.precision)
+    for n_channels, sfreq, duration, n_runs, trigger_rate, precision in grid:
+        print(f"case: {n_channels} channels, {sfreq:g} Hz, {n_runs} x {duration:g} s, {trigger_rate:g} triggers/s, "
+              f"{args.source_format} -> {precision}")
+        case = run_case(args.workdir, n_channels, sfreq, duration, n_runs, trigger_rate, anat=args.anat,
+                        end_to_end=not args.no_end_to_end, source_format=args.source_format,
+                        precision=None if precision == "source" else precision)
+        for stage, result in case["stages"].items():
+            print(f"    {stage:<16}{result['wall_s']:>8.2f} s {result['peak_mb']:>10.1f} MB")
+        print(f"    output: {case['output_bytes'] / 1e6:.1f} MB (input {case['input_bytes'] / 1e6:.1f} MB)")
+        results["cases"].append(case)
+
+    shutil.rmtree(args.workdir, ignore_errors=True)
+    with open(args.out, 'w') as stream:
+        json.dump(results, stream, indent=2)
+    print(f"\nresults written to {args.out}")
+
+
+
+
+# %% main ---------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+## Synthetic Cerca-style OPM recordings for benchmarking the BIDS conversion.
+# Harrison Ritz (2025)
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import datetime
+import numpy as np
+import mne
+from mne.io.constants import FIFF
+
+
+# %% generators ---------------------------------------------------------------
+
+def make_recording(fn, n_channels=64, sfreq=1000.0, duration=60.0, trigger_rate=1.0, n_aux=8,
+                   meas_date=None, fmt="single", seed=0):
+    """
+    Writes a synthetic OPM recording in the layout of a Cerca `_meg.fif` file.
+    The file holds `n_channels` magnetometers with OPM coil types, `n_aux` auxiliary/reference channels and two
+    digital trigger channels ("Trigger 1"/"Trigger 2"). Triggers are 20 ms pulses with codes 2-5, placed at
+    `trigger_rate` pulses per second (0 for an empty room recording) and also stored as "Trigger N" annotations,
+    as in the files exported by the acquisition software. Samples are stored in format `fmt` ("single" or "double").
+    Returns:
+        str: The path of the written file.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_times = int(round(duration * sfreq))
+
+    ch_names = ([f"OPM{ii:03}" for ii in range(n_channels)] + [f"AUX{ii:03}" for ii in range(n_aux)]
+                + ["Trigger 1", "Trigger 2"])
+    ch_types = ["mag"] * n_channels + ["ref_meg"] * (n_aux // 2) + ["misc"] * (n_aux - n_aux // 2) + ["stim"] * 2
+    info = mne.create_info(ch_names, sfreq, ch_types)
+    for ch in info["chs"][:n_channels]:
+        ch["coil_type"] = FIFF.FIFFV_COIL_QUSPIN_ZFOPM_MAG2
+    info["line_freq"] = 60.0
+
+    data = rng.standard_normal((len(ch_names), n_times), dtype=np.float32) * 1e-12
+    times = np.arange(n_times) / sfreq
+    data[:n_channels] += 5e-12 * np.sin(2 * np.pi * 60.0 * times)
+    data[-2:] = 0
+
+    onsets = np.linspace(0.5 * sfreq, n_times - 0.5 * sfreq, int(duration * trigger_rate)).astype(int)
+    codes = rng.integers(2, 6, len(onsets))
+    width = max(int(0.02 * sfreq), 2)
+    for onset, code in zip(onsets, codes):
+        data[-2 + (code % 2), onset:onset + width] = code
+
+    raw = mne.io.RawArray(data, info, verbose=False)
+    meas_date = meas_date or datetime.datetime(2025, 2, 21, 15, 0, 0, tzinfo=datetime.timezone.utc)
+    raw.set_meas_date(meas_date)
+    raw.set_annotations(mne.Annotations(onsets / sfreq, width / sfreq, [f"Trigger {code}" for code in codes],
+                                        orig_time=meas_date))
+
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    raw.save(fn, fmt=fmt, overwrite=True, verbose=False)
+    return fn
+
+
+
+
+def make_anat(fn, shape=(176, 256, 256), seed=0):
+    """Writes a synthetic T1w NIfTI image (requires nibabel)."""
+
+    import nibabel as nib
+
+    rng = np.random.default_rng(seed)
+    image = nib.Nifti1Image(rng.integers(0, 255, shape, dtype=np.uint8), np.eye(4))
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    nib.save(image, fn)
+    return fn
+
+
+
+
+def make_session(root, subj=1, n_runs=5, n_channels=64, sfreq=1000.0, duration=60.0, trigger_rate=1.0,
+                 n_aux=8, emptyroom_duration=None, anat=False, fmt="single", seed=0):
+    """
+    Writes a synthetic session (runs, empty room and optionally a T1w image) under `root`, using the Cerca
+    `sub-XXX/<prefix>_cMEG_Data/<prefix>_meg.fif` layout expected by opm_format_bids.
+    Returns:
+        dict: A configuration for opm_format_bids.bids_conversion that converts the session to `<root>/bids`.
+    """
+
+    raw_dir = os.path.join(root, "raw")
+    start = datetime.datetime(2025, 2, 21, 15, 0, 0, tzinfo=datetime.timezone.utc)
+
+    def _write(prefix, date, rate, dur, offset):
+        fn = os.path.join(raw_dir, f"sub-{subj:03}", f"{prefix}_cMEG_Data", f"{prefix}_meg.fif")
+        make_recording(fn, n_channels=n_channels, sfreq=sfreq, duration=dur, trigger_rate=rate, n_aux=n_aux,
+                       meas_date=date, fmt=fmt, seed=seed + offset)
+
+    emptyroom_date = start - datetime.timedelta(hours=1)
+    emptyroom = emptyroom_date.strftime("%Y%m%d_%H%M%S")
+    _write(emptyroom, emptyroom_date, 0.0, emptyroom_duration or duration, 0)
+
+    runs = list()
+    for rr in range(n_runs):
+        date = start + datetime.timedelta(seconds=rr * (duration + 60))
+        runs.append(date.strftime("%Y%m%d_%H%M%S"))
+        _write(runs[-1], date, trigger_rate, duration, rr + 1)
+
+    anat_path = make_anat(os.path.join(raw_dir, f"sub-{subj:03}", "mri", "t1w.nii"), seed=seed) if anat else None
+
+    return {
+        "dirs": {
+            "data_dir": raw_dir,
+            "emptyroom_dir": raw_dir,
+            "anat_path": anat_path,
+            "bids_dir": os.path.join(root, "bids"),
+        },
+        "session": {
+            "ids": subj,
+            "task": "bench",
+            "session": "01",
+            "run_prefix": runs,
+            "emptyroom_prefix": emptyroom,
+        },
+        "trigger": {
+            "find_events": False,
+            "stim_id": [["Trigger 1", "Trigger 1", "Trigger 2", "Trigger 2"]] * n_runs,
+            "old_trigger_id": [[2, 4, 3, 5]] * n_runs,
+            "new_trigger_id": [[2, 4, 3, 5]] * n_runs,
+            "rename_annot": True,
+            "event_desc": {"Trigger 2": "iti", "Trigger 3": "vis", "Trigger 4": "aud", "Trigger 5": "audvis"},
+        },
+        "recording_info": {"line_freq": 60.0},
+        "output": {"buffer_size_sec": 10.0, "split_size": "2GB"},
+    }
@@ -56,7 +56,7 @@ use_maxwell_filter = True
 mf_st_duration = 10.0
 mf_int_order = 4
 
-mf_reference_run = '01'
+mf_reference_run = '01'  # the concatenated session, or the first run with output.separate_runs
 
 mf_esss = 0  # extended SSS
 mf_esss_reject = None
@@ -6,9 +6,24 @@ conda activate mne-opm
 ## format data for bids ----------------------------------------
 # edit the configuration settings in `src/opm_format_bids.py`
 # call the right location for opm_format_bids
+# add `--jobs N` to load runs in parallel
 
 python /Users/hr0283/Projects/mne-opm/src/opm_format_bids.py "/Users/hr0283/Projects/mne-opm/config/sub-004/config-bids_sub-004.yml"
 
+# or convert every subject under `config` (skips subjects that are already up to date)
+# python /Users/hr0283/Projects/mne-opm/src/opm_format_bids.py batch "/Users/hr0283/Projects/mne-opm/config" --workers 4
+
+# check configs, or list what would be written, without converting
+# python /Users/hr0283/Projects/mne-opm/src/opm_format_bids.py validate "/Users/hr0283/Projects/mne-opm/config"
+# python /Users/hr0283/Projects/mne-opm/src/opm_format_bids.py plan "/Users/hr0283/Projects/mne-opm/config"
+
+# or index recordings and sessions in a catalog, and convert the sessions it lists as not yet converted
+# python /Users/hr0283/Projects/mne-opm/src/opm_catalog.py index "/Users/hr0283/Projects/mne-opm/data/raw" --configs "/Users/hr0283/Projects/mne-opm/config"
+# python /Users/hr0283/Projects/mne-opm/src/opm_format_bids.py batch --catalog opm_catalog.sqlite --workers 4
+
+# or leave a watcher running on the acquisition share: it converts each session a few minutes after its last run
+# python /Users/hr0283/Projects/mne-opm/src/opm_watch.py "/Users/hr0283/Projects/mne-opm/data/raw" --template "/Users/hr0283/Projects/mne-opm/config/config-bids_template.yml" --config-dir "/Users/hr0283/Projects/mne-opm/config"
+
 
 ## run preproc pipeline ----------------------------------------
 # edit the configuration settings in `config`
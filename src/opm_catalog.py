@@ -0,0 +1,337 @@
+## Index Cerca OPM recordings and BIDS conversions in a SQLite catalog.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+# mne is imported when headers are read, so that list and query start quickly.
+
+import os
+import glob
+import json
+import sqlite3
+import argparse
+
+import opm_format_bids
+
+
+
+
+# %% schema -------------------------------------------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subject_dirs (
+    path TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    data_dir TEXT,
+    subject INTEGER,
+    prefix TEXT,
+    acq_time TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sfreq REAL,
+    n_channels INTEGER,
+    duration REAL,
+    stim_channels TEXT,
+    n_annotations INTEGER,
+    error TEXT,
+    status TEXT DEFAULT 'unconverted',
+    bids_output TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_subject ON recordings (subject, acq_time);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    config TEXT PRIMARY KEY,
+    subject INTEGER,
+    session TEXT,
+    task TEXT,
+    n_runs INTEGER,
+    bids_dir TEXT,
+    status TEXT,
+    stale TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_task ON sessions (task, status);
+"""
+
+
+
+
+def connect(db_path):
+    """Opens (and if needed creates) the catalog database at `db_path`."""
+
+    db = sqlite3.connect(db_path)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+
+
+# %% indexing -----------------------------------------------------------------
+
+def _read_recording(fn, prefix):
+    """Header metadata of one recording (no data buffers are read)."""
+
+    import mne
+
+    raw = mne.io.read_raw_fif(fn, preload=False, verbose="error")
+    acq_time = opm_format_bids._prefix_time(prefix)
+    if acq_time is None and raw.info["meas_date"] is not None:
+        acq_time = raw.info["meas_date"].astimezone().replace(tzinfo=None)
+    stim = [raw.ch_names[pick] for pick in mne.pick_types(raw.info, meg=False, stim=True)]
+
+    return {
+        "acq_time": acq_time.isoformat() if acq_time else None,
+        "sfreq": raw.info["sfreq"],
+        "n_channels": len(raw.ch_names),
+        "duration": raw.n_times / raw.info["sfreq"],
+        "stim_channels": ",".join(stim),
+        "n_annotations": len(raw.annotations),
+        "error": None,
+    }
+
+
+
+
+def index_recordings(db, data_dir):
+    """
+    Adds the recordings under `data_dir` (`sub-XXX/<prefix>_cMEG_Data/<prefix>_meg.fif`) to the catalog. Every
+    recording is stat()ed, and only those whose size or mtime changed have their header read, so re-indexing an
+    unchanged archive costs one stat() per recording. (Directory mtimes are not enough: a FIF that lands in an
+    existing recording folder, or is rewritten in place, does not change its subject directory.)
+    Returns:
+        tuple: (number of recordings read, number removed).
+    """
+
+    data_dir = os.path.abspath(data_dir)
+    n_read = n_removed = 0
+
+    subject_dirs = sorted(glob.glob(os.path.join(data_dir, "sub-*")))
+    for subject_dir in subject_dirs:
+        try:
+            subj = int(os.path.basename(subject_dir)[len("sub-"):])
+        except ValueError:
+            continue
+        known = {row["path"]: row for row in db.execute(
+            "SELECT path, size, mtime_ns FROM recordings WHERE path LIKE ?", (subject_dir + os.sep + "%",))}
+
+        found = set()
+        for recording_dir in glob.glob(os.path.join(subject_dir, "*_cMEG_Data")):
+            prefix = os.path.basename(recording_dir)[:-len("_cMEG_Data")]
+            fn = opm_format_bids._raw_path(data_dir, subj, prefix)
+            if not os.path.isfile(fn):
+                continue
+            found.add(fn)
+            stat = os.stat(fn)
+            if fn in known and (known[fn]["size"], known[fn]["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            try:
+                header = _read_recording(fn, prefix)
+            except Exception as err:
+                header = {"acq_time": None, "sfreq": None, "n_channels": None, "duration": None,
+                          "stim_channels": None, "n_annotations": None, "error": f"{type(err).__name__}: {err}"}
+            db.execute(
+                "INSERT OR REPLACE INTO recordings (path, data_dir, subject, prefix, size, mtime_ns, acq_time, sfreq, "
+                "n_channels, duration, stim_channels, n_annotations, error) "
+                "VALUES (:path, :data_dir, :subject, :prefix, :size, :mtime_ns, :acq_time, :sfreq, :n_channels, "
+                ":duration, :stim_channels, :n_annotations, :error)",
+                {"path": fn, "data_dir": data_dir, "subject": subj, "prefix": prefix,
+                 "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, **header})
+            n_read += 1
+
+        for fn in set(known) - found:
+            db.execute("DELETE FROM recordings WHERE path = ?", (fn,))
+            n_removed += 1
+        db.execute("INSERT OR IGNORE INTO subject_dirs (path) VALUES (?)", (subject_dir,))
+
+    # subject directories that disappeared
+    for row in db.execute("SELECT path FROM subject_dirs WHERE path LIKE ?", (data_dir + os.sep + "%",)).fetchall():
+        if row["path"] not in subject_dirs:
+            n_removed += db.execute("DELETE FROM recordings WHERE path LIKE ?", (row["path"] + os.sep + "%",)).rowcount
+            db.execute("DELETE FROM subject_dirs WHERE path = ?", (row["path"],))
+
+    db.commit()
+    return n_read, n_removed
+
+
+
+
+def index_conversions(db, bids_dir):
+    """
+    Sets the conversion status of the catalogued recordings from the conversion manifests in `bids_dir`:
+    "converted" if a recording is an input of a committed output whose fingerprint still matches the file, "stale"
+    if the file changed since, and "unconverted" otherwise.
+    """
+
+    manifest_dir = os.path.join(bids_dir, "derivatives", "opm_format_bids")
+    for manifest_fn in glob.glob(os.path.join(manifest_dir, "*_manifest.json")):
+        with open(manifest_fn, 'r') as stream:
+            manifest = json.load(stream)
+        for entry in manifest.get("outputs", {}).values():
+            if not opm_format_bids._output_exists(entry["output"]):
+                continue
+            for fn, fingerprint in entry["inputs"].items():
+                row = db.execute("SELECT size, mtime_ns FROM recordings WHERE path = ?", (fn,)).fetchone()
+                if row is None:
+                    continue
+                unchanged = (row["size"], row["mtime_ns"]) == (fingerprint["size"], fingerprint["mtime_ns"])
+                db.execute("UPDATE recordings SET status = ?, bids_output = ? WHERE path = ?",
+                           ("converted" if unchanged else "stale", entry["output"], fn))
+    db.commit()
+
+
+
+
+def index_sessions(db, batch_path):
+    """
+    Adds the subject configs listed by opm_format_bids.find_configs(batch_path) to the catalog, with their
+    conversion status from a stat-only opm_format_bids.conversion_plan: "converted" (every output up to date),
+    "partial", "unconverted" or "invalid" (the config does not validate). The recordings' status is then updated
+    from the manifests of each BIDS root the configs write to (see index_conversions), once per root.
+    """
+
+    import yaml
+
+    bids_dirs = dict()  # in order of first use
+    for config_path in opm_format_bids.find_configs(batch_path):
+        config_path = os.path.abspath(config_path)
+        try:
+            cfg = opm_format_bids.set_bids_params(config_path)
+            stale, entries = opm_format_bids.conversion_plan(cfg, rehash=False)
+        except (OSError, ValueError, yaml.YAMLError) as err:
+            db.execute("INSERT OR REPLACE INTO sessions (config, status, error) VALUES (?, 'invalid', ?)",
+                       (config_path, str(err)))
+            continue
+
+        status = "converted" if not stale else "unconverted" if len(stale) == len(entries) else "partial"
+        db.execute(
+            "INSERT OR REPLACE INTO sessions (config, subject, session, task, n_runs, bids_dir, status, stale, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+            (config_path, cfg.session.ids, cfg.session.session, cfg.session.task, len(cfg.session.run_prefix),
+             cfg.dirs.bids_dir, status, ",".join(stale)))
+        bids_dirs[os.path.abspath(cfg.dirs.bids_dir)] = None
+
+    for bids_dir in bids_dirs:
+        index_conversions(db, bids_dir)
+    db.commit()
+
+
+
+
+# %% queries ------------------------------------------------------------------
+
+def pending_configs(db_path, task=None, subjects=None):
+    """
+    Configs in the catalog whose conversion is not complete ("unconverted" or "partial"), optionally restricted to
+    one task and to a list of subjects, for opm_format_bids.run_batch.
+    """
+
+    db = connect(db_path)
+    query = "SELECT config FROM sessions WHERE status IN ('unconverted', 'partial')"
+    params = list()
+    if task:
+        query += " AND task = ?"
+        params.append(task)
+    if subjects:
+        query += f" AND subject IN ({', '.join('?' * len(subjects))})"
+        params.extend(subjects)
+    return [row["config"] for row in db.execute(query + " ORDER BY subject, session", params)]
+
+
+
+
+def _print_rows(rows):
+    rows = list(rows)
+    if not rows:
+        print("(no rows)")
+        return
+    columns = rows[0].keys()
+    widths = [max(len(str(column)), *(len(str(row[column])) for row in rows)) for column in columns]
+    print("  ".join(f"{column:<{width}}" for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(f"{'' if row[column] is None else row[column]!s:<{width}}" for column, width in zip(columns, widths)))
+
+
+
+
+# %% main ---------------------------------------------------------------------
+
+def main(argv=None):
+    """
+    Command line entry point, with the subcommands:
+        index   Index the recordings under data directories, and the sessions of subject configs.
+        list    List recordings or sessions, filtered by subject, task and status.
+        query   Run a read-only SQL query against the catalog.
+    """
+
+    parser = argparse.ArgumentParser(description="Catalog of Cerca OPM recordings and their BIDS conversions.")
+    parser.add_argument("--db", default="opm_catalog.sqlite", help="catalog database (default: opm_catalog.sqlite)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index = subparsers.add_parser("index", help="index recordings and sessions (incrementally)")
+    index.add_argument("data_dirs", nargs="*", metavar="DATA_DIR", help="raw data directories containing sub-XXX folders")
+    index.add_argument("--configs", action="append", default=[], metavar="PATH",
+                       help="config directory or manifest file of sessions to index (repeatable)")
+    index.add_argument("--bids-dir", action="append", default=[], metavar="DIR",
+                       help="BIDS root whose conversion manifests give the recordings' status (repeatable)")
+
+    listing = subparsers.add_parser("list", help="list recordings or sessions")
+    listing.add_argument("table", choices=("recordings", "sessions"))
+    listing.add_argument("--subject", type=int, action="append", help="only these subjects (repeatable)")
+    listing.add_argument("--task", help="only sessions of this task")
+    listing.add_argument("--status", action="append",
+                         help="only this status (repeatable): converted, stale, partial, unconverted, invalid")
+
+    query = subparsers.add_parser("query", help="run a read-only SQL query")
+    query.add_argument("sql", help='e.g. "SELECT subject, session FROM sessions WHERE task = \'AVpilot\' AND status != \'converted\'"')
+
+    args = parser.parse_args(argv)
+
+    if args.command == "index":
+        db = connect(args.db)
+        for data_dir in args.data_dirs:
+            n_read, n_removed = index_recordings(db, data_dir)
+            print(f"{data_dir}: {n_read} recordings (re)read, {n_removed} removed")
+        for batch_path in args.configs:
+            index_sessions(db, batch_path)
+        for bids_dir in args.bids_dir:
+            index_conversions(db, bids_dir)
+        print(f"{db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0]} recordings and "
+              f"{db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]} sessions in {args.db}")
+
+    elif args.command == "list":
+        db = connect(args.db)
+        if args.table == "recordings":
+            query_sql = ("SELECT subject, prefix, acq_time, sfreq, n_channels, ROUND(duration, 1) AS duration, "
+                         "stim_channels, status FROM recordings WHERE 1")
+        else:
+            query_sql = "SELECT subject, session, task, n_runs, status, stale, config FROM sessions WHERE 1"
+        params = list()
+        if args.subject:
+            query_sql += f" AND subject IN ({', '.join('?' * len(args.subject))})"
+            params.extend(args.subject)
+        if args.task and args.table == "sessions":
+            query_sql += " AND task = ?"
+            params.append(args.task)
+        if args.status:
+            query_sql += f" AND status IN ({', '.join('?' * len(args.status))})"
+            params.extend(args.status)
+        order = "subject, acq_time" if args.table == "recordings" else "subject, session"
+        _print_rows(db.execute(f"{query_sql} ORDER BY {order}", params))
+
+    elif args.command == "query":
+        db = sqlite3.connect(f"file:{os.path.abspath(args.db)}?mode=ro", uri=True)
+        db.row_factory = sqlite3.Row
+        _print_rows(db.execute(args.sql))
+
+
+
+
+if __name__ == "__main__":
+    main()
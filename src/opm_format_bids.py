@@ -5,19 +5,287 @@
 
 
 # %% import -------------------------------------------------------------------
+# mne, mne_bids, numpy, yaml and the process pools are imported by the functions that use them, so that the validate and plan
+# commands (and --help) start without paying for them.
 
-import mne
-import mne_bids
 import os
-import numpy as np
 import datetime
-import yaml
+import argparse
+import glob
+import time
+import json
+import hashlib
+import resource
 import sys
+import threading
+import fcntl
+import re
+import struct
+import queue
+import bisect
+import csv
+import shutil
+import fnmatch
+import types
+import multiprocessing
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, asdict
+from itertools import repeat
+
+
+# %% configuration ------------------------------------------------------------
+
+@dataclass(slots=True)
+class DirsConfig:
+    data_dir: str
+    emptyroom_dir: str
+    bids_dir: str
+    anat_path: str | None = None
+
+
+@dataclass(slots=True)
+class SessionConfig:
+    ids: int
+    task: str
+    session: str
+    run_prefix: list[str]
+    emptyroom_prefix: str | None = None
+
+
+@dataclass(slots=True)
+class TriggerConfig:
+    find_events: bool = False
+    rename_annot: bool = False
+    event_desc: dict = field(default_factory=dict)
+    stim_id: list[list[str]] = field(default_factory=list)
+    old_trigger_id: list[list[int]] = field(default_factory=list)
+    new_trigger_id: list[list[int]] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class RecordingInfoConfig:
+    line_freq: float = 60.0
+
+
+@dataclass(slots=True)
+class OutputConfig:
+    buffer_size_sec: float = 10.0
+    split_size: str | int = "2GB"
+    shared_emptyroom: bool = False
+    precision: str | None = None
+    separate_runs: bool = False
+    passthrough: bool = True
+
+
+@dataclass(slots=True)
+class InputConfig:
+    prefetch_depth: int = 1
+    prefetch_mb: float = 2048.0
+    keep_channels: list[str] | None = None
+    drop_channels: list[str] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class QCConfig:
+    enabled: bool = False
+    psd_window_sec: float = 2.0
+    flat_window_sec: float = 1.0
+    flat_ptp: float = 1e-15
+
+
+@dataclass(slots=True)
+class BidsConfig:
+    """
+    Typed configuration of a conversion, with one attribute per YAML section (e.g. cfg.session.run_prefix).
+    Built from the merged YAML with from_dict, which rejects unknown sections and keys, and checked with validate.
+    """
+
+    dirs: DirsConfig
+    session: SessionConfig
+    trigger: TriggerConfig = field(default_factory=TriggerConfig)
+    recording_info: RecordingInfoConfig = field(default_factory=RecordingInfoConfig)
+    output: OutputConfig = field(default_factory=OutputConfig)
+    input: InputConfig = field(default_factory=InputConfig)
+    qc: QCConfig = field(default_factory=QCConfig)
+
+    @classmethod
+    def from_dict(cls, cfg):
+        """Builds a BidsConfig from a (merged) config dictionary, raising ValueError on unknown or missing keys."""
+
+        if not isinstance(cfg, dict):
+            raise ValueError(f"invalid configuration: expected a mapping of sections, got {type(cfg).__name__}")
+
+        errors = list()
+        sections = dict()
+        section_types = {section.name: section.type for section in fields(cls)}
+        for name, values in cfg.items():
+            if name not in section_types:
+                errors.append(f"unknown section '{name}'")
+                continue
+            if values is not None and not isinstance(values, dict):
+                errors.append(f"section '{name}' must be a mapping of keys, got {values!r}")
+                continue
+            section_cls = section_types[name]
+            known = {key.name for key in fields(section_cls)}
+            for key in set(values or {}) - known:
+                hint = " (this is a top-level section)" if key in section_types else ""
+                errors.append(f"unknown key '{name}.{key}'{hint}")
+            try:
+                sections[name] = section_cls(**{key: value for key, value in (values or {}).items() if key in known})
+            except TypeError as err:
+                errors.append(f"section '{name}': {err}")
+        for name in ("dirs", "session"):
+            if name not in cfg:
+                errors.append(f"missing section '{name}'")
+
+        if errors:
+            raise ValueError("invalid configuration:\n  - " + "\n  - ".join(errors))
+        return cls(**sections)
+
+    def to_dict(self):
+        return asdict(self)
+
+    def validate(self, check_files=True):
+        """
+        Checks types, BIDS labels, the per-run trigger tables and (if check_files) that every input exists.
+        All problems are collected and raised together as a single ValueError.
+        """
+
+        errors = list()
+        dirs, session, trigger = self.dirs, self.session, self.trigger
+
+        if not isinstance(session.ids, int) or isinstance(session.ids, bool) or session.ids < 0:
+            errors.append(f"session.ids must be a non-negative integer, got {session.ids!r}")
+        for name in ("task", "session"):
+            label = getattr(session, name)
+            if not isinstance(label, str) or not re.fullmatch(r"[a-zA-Z0-9]+", label):
+                errors.append(f"session.{name} must be an alphanumeric string (quote it in YAML), got {label!r}")
+        if not isinstance(session.run_prefix, list) or not session.run_prefix \
+                or not all(isinstance(run, str) for run in session.run_prefix):
+            errors.append(f"session.run_prefix must be a non-empty list of quoted prefixes, got {session.run_prefix!r}")
+        if session.emptyroom_prefix is not None and not isinstance(session.emptyroom_prefix, str):
+            errors.append(f"session.emptyroom_prefix must be a quoted prefix or null, got {session.emptyroom_prefix!r}")
+        elif self.output.shared_emptyroom and session.emptyroom_prefix not in (None, "auto") \
+                and not re.fullmatch(r"\d{8}_\d{6}", session.emptyroom_prefix):
+            errors.append(f"output.shared_emptyroom needs a YYYYMMDD_HHMMSS emptyroom_prefix, got {session.emptyroom_prefix!r}")
+
+        if not isinstance(self.recording_info.line_freq, (int, float)) or self.recording_info.line_freq <= 0:
+            errors.append(f"recording_info.line_freq must be a positive number, got {self.recording_info.line_freq!r}")
+        if not isinstance(self.output.buffer_size_sec, (int, float)) or self.output.buffer_size_sec <= 0:
+            errors.append(f"output.buffer_size_sec must be a positive number, got {self.output.buffer_size_sec!r}")
+        try:
+            if not 0 < _parse_size(self.output.split_size) <= 2**31:
+                errors.append(f"output.split_size must be positive and at most 2GB, got {self.output.split_size!r}")
+        except (TypeError, ValueError):
+            errors.append(f'output.split_size must be bytes or a size ending in "MB"/"GB", got {self.output.split_size!r}')
+        for name in ("separate_runs", "passthrough"):
+            if not isinstance(getattr(self.output, name), bool):
+                errors.append(f"output.{name} must be true or false, got {getattr(self.output, name)!r}")
+        if self.output.precision not in (None, "single", "double", "short"):
+            errors.append(f'output.precision must be "single", "double", "short" or null, got {self.output.precision!r}')
+        if not isinstance(self.input.prefetch_depth, int) or self.input.prefetch_depth < 0:
+            errors.append(f"input.prefetch_depth must be a non-negative integer, got {self.input.prefetch_depth!r}")
+        if not isinstance(self.input.prefetch_mb, (int, float)) or self.input.prefetch_mb <= 0:
+            errors.append(f"input.prefetch_mb must be a positive number, got {self.input.prefetch_mb!r}")
+        if not isinstance(self.qc.enabled, bool):
+            errors.append(f"qc.enabled must be true or false, got {self.qc.enabled!r}")
+        for name in ("psd_window_sec", "flat_window_sec", "flat_ptp"):
+            value = getattr(self.qc, name)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+                errors.append(f"qc.{name} must be a positive number, got {value!r}")
+        for name in ("keep_channels", "drop_channels"):
+            patterns = getattr(self.input, name)
+            if (patterns is not None or name == "drop_channels") and not (
+                    isinstance(patterns, list) and all(isinstance(pattern, str) for pattern in patterns)):
+                errors.append(f"input.{name} must be a list of channel names, globs or types"
+                              f"{' (or null)' if name == 'keep_channels' else ''}, got {patterns!r}")
+
+        if not isinstance(trigger.event_desc, dict):
+            errors.append(f"trigger.event_desc must be a mapping, got {trigger.event_desc!r}")
+        if trigger.find_events:
+            n_runs = len(session.run_prefix) if isinstance(session.run_prefix, list) else 0
+            for name in ("stim_id", "old_trigger_id", "new_trigger_id"):
+                table = getattr(trigger, name)
+                if not isinstance(table, list) or len(table) != n_runs:
+                    errors.append(f"trigger.{name} must have one list per run ({n_runs}), got {table!r}")
+            if not errors:
+                for rr, entries in enumerate(zip(trigger.stim_id, trigger.old_trigger_id, trigger.new_trigger_id)):
+                    if len({len(entry) for entry in entries}) != 1:
+                        errors.append(f"run {rr}: trigger.stim_id, old_trigger_id and new_trigger_id differ in length")
+
+        if check_files and not errors:
+            for name in ("data_dir", "emptyroom_dir"):
+                if not os.path.isdir(getattr(dirs, name)):
+                    errors.append(f"dirs.{name} does not exist: {getattr(dirs, name)}")
+            if dirs.anat_path and not os.path.isfile(dirs.anat_path):
+                errors.append(f"dirs.anat_path does not exist (set it to null to skip the T1w): {dirs.anat_path}")
+            if not errors:
+                for fn in [_raw_path(dirs.data_dir, session.ids, run) for run in session.run_prefix] + (
+                        [_raw_path(dirs.emptyroom_dir, session.ids, session.emptyroom_prefix)]
+                        if session.emptyroom_prefix not in (None, "auto") else []):
+                    if not os.path.isfile(fn):
+                        errors.append(f"recording not found: {fn}")
+
+        if errors:
+            raise ValueError("invalid configuration:\n  - " + "\n  - ".join(errors))
+
+
+
+
+def _parse_size(size):
+    """Bytes in a split size given as an integer or as a string ending in "MB" or "GB" (as in mne, 1GB = 2**30)."""
+
+    if isinstance(size, str):
+        exp = dict(MB=20, GB=30).get(size[-2:])
+        if exp is None:
+            raise ValueError(f'size has to end with either "MB" or "GB", got {size!r}')
+        return int(float(size[:-2]) * 2**exp)
+    return int(size)
+
+
+
+
+def _merge_config(base, override):
+    """
+    Merges a user config into the base config section by section: keys given in a section replace the base
+    values of that section, and keys that are not given keep their base values. Values themselves (such as the
+    event_desc mapping) are replaced, not merged.
+    """
+
+    if not isinstance(override, dict):
+        raise ValueError(f"invalid configuration: expected a mapping of sections, got {type(override).__name__}")
+
+    merged = {section: dict(values or {}) for section, values in base.items()}
+    for section, values in override.items():
+        if isinstance(values, dict) and isinstance(merged.get(section), dict):
+            merged[section].update(values)
+        else:
+            merged[section] = values
+    return merged
+
+
 
 
 # %% import parameters
 
-def set_bids_params(config_path=""):
+def set_bids_params(config_path="", check_files=True, save_catalog=True):
+    """
+    Loads the embedded base configuration, deep-merges the YAML file at `config_path` into it and validates the
+    result (see BidsConfig.validate), so that misconfigurations fail before any recording is opened. An
+    `emptyroom_prefix` of "auto" is resolved with select_emptyroom (unless check_files is False).
+    Parameters:
+        config_path (str): Subject YAML config; the base configuration alone is used if empty.
+        check_files (bool): Also check that every input directory and file exists.
+        save_catalog (bool): Write the empty room catalog updated by select_emptyroom back to bids_dir (False for
+            the read-only validate and plan commands).
+    Returns:
+        BidsConfig: The validated configuration.
+    Raises:
+        ValueError: Listing every problem found in the configuration.
+        yaml.YAMLError: If the config file is not valid YAML.
+    """
+
+    import yaml
 
     # set-up configuration ==========================================================================================================
     print("\n\n\nloading configuration ---------------------------------------------------\n")
@@ -59,6 +327,29 @@ def set_bids_params(config_path=""):
     recording_info:        
         line_freq: 60.0
 
+
+    output:
+        buffer_size_sec: 10.0
+        split_size: "2GB"
+        shared_emptyroom: false
+        precision: null         # sample format of the MEG outputs: "single", "double" or "short"; null keeps the source format
+        separate_runs: false    # write each run as its own run-NN output instead of concatenating them into run-01
+        passthrough: true       # copy the data buffers of the sources verbatim when no sample changes
+
+
+    input:
+        prefetch_depth: 1       # runs read ahead while events are decoded (only with trigger.find_events)
+        prefetch_mb: 2048
+        keep_channels: null     # e.g. ["mag", "STI*"]: names, globs or channel types; null keeps every channel
+        drop_channels: []       # e.g. ["ref_meg", "misc"]: removed after keep_channels
+
+
+    qc:
+        enabled: false          # per-channel statistics of the MEG outputs, see ChannelQC (reads every sample)
+        psd_window_sec: 2.0
+        flat_window_sec: 1.0
+        flat_ptp: 1.0e-15       # in channel units (T for magnetometers)
+
     """
 
     # Load config file
@@ -67,212 +358,2535 @@ def set_bids_params(config_path=""):
     print(f"\n\nloading config: {config_path}\n")
     if config_path:
         with open(config_path, 'r') as stream:
-            proc = yaml.safe_load(stream)
-        cfg.update(proc)
+            proc = yaml.safe_load(stream) or {}
+        cfg = _merge_config(cfg, proc)
+
+    cfg = BidsConfig.from_dict(cfg)
+    cfg.validate(check_files=check_files)
+
+    # emptyroom_prefix: auto picks the empty room recorded closest in time to the first run
+    if cfg.session.emptyroom_prefix == "auto" and check_files:
+        cfg.session.emptyroom_prefix = select_emptyroom(cfg, save_catalog=save_catalog)
+        cfg.validate(check_files=check_files)
 
     return cfg
 
 
 
 
-def bids_conversion(cfg):
+# %% empty room catalog -------------------------------------------------------
+
+def _prefix_time(prefix):
+    """Acquisition time encoded in a Cerca YYYYMMDD_HHMMSS prefix (local time), or None if it has another form."""
+
+    try:
+        return datetime.datetime.strptime(prefix, "%Y%m%d_%H%M%S")
+    except ValueError:
+        return None
+
+
+
+
+def _scan_recordings(subject_dir, previous=None):
     """
-    Converts raw MEG data files to BIDS format using configuration parameters provided in the cfg dictionary.
-    This function performs the following steps:
-        1. Extracts necessary configuration parameters such as subject ID, session information, run prefixes,
-           empty room prefix, task name, and anatomical scan indicator.
-        2. Reads and processes the empty room file if specified in cfg["session"]["emptyroom_prefix"]. The
-           empty room raw data is read, its line frequency updated based on cfg["recording_info"]["line_freq"],
-           and then written to a BIDS-compatible directory structure.
-        3. Iterates over each run specified in cfg["session"]["run_prefix"]:
-            - Constructs the file path for the raw MEG data.
-            - Reads the raw data and updates its metadata (line frequency and subject information).
-            - Optionally finds and merges events if cfg["trigger"]["find_events"] is True, setting the resulting
-              annotations on the raw data.
-            - Appends the processed raw data for later concatenation.
-        4. Concatenates the individual raw run data into a single raw object and prints the recording duration.
-        5. Optionally renames annotation descriptions if cfg["trigger"]["rename_annot"] is True.
-        6. Associates the empty room information with the concatenated raw object if applicable.
-        7. Writes the concatenated raw data to the BIDS directory.
-        8. If an anatomical scan is provided (cfg["dirs"]["anat_path"] is not None), writes the anatomical image
-           to the BIDS structure.
+    Lists the recordings in one subject directory of the raw data as sorted [time, prefix, n_annotations] rows.
+    The time is taken from the prefix, or else from the header's meas_date (in local time); the header is only
+    read for the annotation count and for prefixes without a time. Recordings whose size and mtime match
+    `previous` (the subject's catalog entry) keep their row without their header being read again, and mne is only
+    imported once a header has to be read.
+    Returns:
+        tuple: (rows, files), with files {prefix: [size, mtime_ns]} of every recording found.
+    """
+
+    previous = previous or {}
+    known_files = previous.get("files", {})
+    known_rows = {row[1]: row for row in previous.get("recordings", [])}
+
+    rows, files = list(), dict()
+    for data_dir in glob.glob(os.path.join(subject_dir, "*_cMEG_Data")):
+        prefix = os.path.basename(data_dir)[:-len("_cMEG_Data")]
+        fn = os.path.join(data_dir, f"{prefix}_meg.fif")
+        try:
+            stat = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        files[prefix] = [stat.st_size, stat.st_mtime_ns]
+        if known_files.get(prefix) == files[prefix] and prefix in known_rows:
+            rows.append(known_rows[prefix])
+            continue
+        import mne
+        try:
+            raw = mne.io.read_raw_fif(fn, preload=False, verbose="error")
+        except Exception as err:
+            print(f"skipping unreadable recording {fn}: {err}")
+            continue
+        when = _prefix_time(prefix)
+        if when is None and raw.info["meas_date"] is not None:
+            when = raw.info["meas_date"].astimezone().replace(tzinfo=None)
+        if when is not None:
+            rows.append([when.isoformat(), prefix, len(raw.annotations)])
+    return sorted(rows), files
+
+
+
+
+def update_emptyroom_catalog(emptyroom_dir, catalog_fn, subjects=None, save=True):
+    """
+    Builds or updates the catalog of the recordings under `emptyroom_dir`, stored as JSON at `catalog_fn`.
+    Recordings are indexed per subject directory (`sub-*`), sorted by acquisition time. Every recording is
+    stat()ed, and only those whose size or mtime changed have their header read, so keeping the catalog up to date
+    costs one stat() per recording. (A subject directory's mtime is not enough: a FIF that lands in an existing
+    recording folder does not change it.)
     Parameters:
-        cfg (dict): A configuration dictionary containing settings required for the conversion.
-            Must include the following keys:
-                - "session": A dictionary with keys:
-                    - "ids": Subject identifier.
-                    - "run_prefix": List of run prefixes.
-                    - "emptyroom_prefix": Prefix for empty room data (evaluated as False if not provided).
-                    - "task": Task name.
-                    - "session": Session label.
-                - "dirs": A dictionary with keys:
-                    - "data_dir": Base directory for raw MEG data.
-                    - "emptyroom_dir": Directory containing empty room files.
-                    - "anat_path": Path to anatomical scans (evaluated as False if not provided).
-                    - "bids_dir": Output directory for BIDS formatted data.
-                - "recording_info": A dictionary with key:
-                    - "line_freq": The line frequency value to be set in the raw data info.
-                - "trigger": A dictionary with keys:
-                    - "find_events": Boolean flag to determine if events should be located.
-                    - "stim_id": List of stimulus channel identifiers per run.
-                    - "old_trigger_id": List of trigger IDs to be replaced.
-                    - "new_trigger_id": List of new trigger IDs to use.
-                    - "event_desc": Dictionary mapping event codes to descriptions.
-                    - "rename_annot": Boolean flag to determine if annotations should be renamed.
+        emptyroom_dir (str): Directory with the sub-XXX folders of the raw data.
+        catalog_fn (str): JSON file of the catalog.
+        subjects (list of str): Only update these subject directories (e.g. ["sub-004"]); the entries of the
+            others are kept as they are. Defaults to every `sub-*` directory.
+        save (bool): Write the updated catalog back to `catalog_fn`. Defaults to True.
+    Returns:
+        dict: {"emptyroom_dir": ..., "subjects": {"sub-XXX": {"files": {prefix: [size, mtime_ns]}, "recordings":
+            [[time, prefix, n_annotations], ...]}}}.
+    """
+
+    catalog = {"emptyroom_dir": os.path.abspath(emptyroom_dir), "subjects": {}}
+    if os.path.exists(catalog_fn):
+        with open(catalog_fn, 'r') as stream:
+            previous = json.load(stream)
+        if previous.get("emptyroom_dir") == catalog["emptyroom_dir"]:
+            catalog = previous
+
+    changed = False
+    if subjects is None:
+        subjects = [entry.name for entry in os.scandir(emptyroom_dir) if entry.is_dir() and entry.name.startswith("sub-")]
+        for name in set(catalog["subjects"]) - set(subjects):
+            del catalog["subjects"][name]
+            changed = True
+    for name in subjects:
+        subject_dir = os.path.join(emptyroom_dir, name)
+        if not os.path.isdir(subject_dir):
+            changed |= catalog["subjects"].pop(name, None) is not None
+            continue
+        previous = catalog["subjects"].get(name, {})
+        rows, files = _scan_recordings(subject_dir, previous)
+        if files != previous.get("files") or rows != previous.get("recordings"):
+            catalog["subjects"][name] = {"files": files, "recordings": rows}
+            changed = True
+
+    if changed and save:
+        os.makedirs(os.path.dirname(catalog_fn), exist_ok=True)
+        with open(f"{catalog_fn}.{os.getpid()}.tmp", 'w') as stream:
+            json.dump(catalog, stream, indent=2, sort_keys=True)
+        os.replace(f"{catalog_fn}.{os.getpid()}.tmp", catalog_fn)
+    return catalog
+
+
+
+
+def nearest_emptyroom(recordings, when, exclude=()):
+    """
+    Finds the empty room recording closest in time to `when` by bisection of the time-sorted catalog `recordings`
+    (see update_emptyroom_catalog). Recordings with annotations (i.e. triggers, as in task runs) and the prefixes
+    in `exclude` are not empty rooms and are skipped.
+    Returns:
+        tuple: (prefix, time difference in seconds), or (None, None) if there is no candidate.
+    """
+
+    times = [row[0] for row in recordings]
+    index = bisect.bisect_left(times, when.isoformat())
+    best = (None, None)
+    # walk outwards from the insertion point; the first candidate on each side is the closest one on that side
+    for indices in (range(index - 1, -1, -1), range(index, len(recordings))):
+        for ii in indices:
+            time_iso, prefix, n_annotations = recordings[ii]
+            if n_annotations or prefix in exclude:
+                continue
+            gap = abs((datetime.datetime.fromisoformat(time_iso) - when).total_seconds())
+            if best[1] is None or gap < best[1]:
+                best = (prefix, gap)
+            break
+    return best
+
+
+
+
+def select_emptyroom(cfg, save_catalog=True):
+    """
+    Resolves `emptyroom_prefix: auto`: the empty room recording in the subject's directory under
+    cfg.dirs.emptyroom_dir that is closest in time to the first run. The catalog is kept in
+    `<bids_dir>/derivatives/opm_format_bids`, and the subject's entry is updated incrementally (see
+    update_emptyroom_catalog); with save_catalog=False the update is not written back, e.g. for a dry run.
     Returns:
-        None
+        str: The selected prefix.
     Raises:
-        Any exceptions raised from file I/O operations, MNE functions, or issues during raw concatenation are
-        propagated to the caller.
-    Note:
-        This function requires the mne and mne_bids libraries to be imported in the calling environment.
+        ValueError: If the subject has no empty room recording, or the first run's time is unknown.
     """
 
-    # %% convert to BIDS ---------------------------------------------------------
+    subj = cfg.session.ids
+    catalog_fn = os.path.join(cfg.dirs.bids_dir, "derivatives", "opm_format_bids",
+                              f"emptyroom_catalog-{hashlib.sha256(os.path.abspath(cfg.dirs.emptyroom_dir).encode()).hexdigest()[:8]}.json")
+    catalog = update_emptyroom_catalog(cfg.dirs.emptyroom_dir, catalog_fn, subjects=[f"sub-{subj:03}"],
+                                       save=save_catalog)
+    recordings = catalog["subjects"].get(f"sub-{subj:03}", {}).get("recordings", [])
 
-    subj = cfg["session"]["ids"]
-    runs = cfg["session"]["run_prefix"]
-    emptyroom = cfg["session"]["emptyroom_prefix"]
-    task = cfg["session"]["task"]
-    anat_path = cfg["dirs"]["anat_path"]
+    first_run = cfg.session.run_prefix[0]
+    when = _prefix_time(first_run)
+    if when is None:
+        import mne
+        meas_date = mne.io.read_info(_raw_path(cfg.dirs.data_dir, subj, first_run), verbose="error")["meas_date"]
+        if meas_date is None:
+            raise ValueError(f"cannot select an empty room: run {first_run} has no acquisition time")
+        when = meas_date.astimezone().replace(tzinfo=None)
 
-    raw_list = list()
-    print("\nparticipant: ", subj,
-          "\nruns: ", runs,
-          "\nemptyroom: ", emptyroom,
-          "\ntask: ", task,
-          "\nanat path: ", anat_path,
-          "\n--------\n")
-    
-    # Process empty room data ------------------------------------------------
-    if emptyroom:
-
-        fn_empty_room = os.path.join(
-            cfg['dirs']['emptyroom_dir'], 
-            f"sub-{subj:03}", 
-            f"{emptyroom}_cMEG_Data", 
-            f"{emptyroom}_meg.fif"
-            )
-        
-        raw_empty_room = mne.io.read_raw_fif(fn_empty_room)
-        raw_empty_room.info["line_freq"] = cfg["recording_info"]["line_freq"]
-        
-        emptyroom_bids_path = mne_bids.BIDSPath(
-            subject=f"{subj:03}",
-            session=cfg["session"]["session"],
-            task="noise",
-            root=cfg['dirs']['bids_dir'],
-        )
-        
+    prefix, gap = nearest_emptyroom(recordings, when, exclude=set(cfg.session.run_prefix))
+    if prefix is None:
+        raise ValueError(f"cannot select an empty room: no recording without annotations in "
+                         f"{os.path.join(cfg.dirs.emptyroom_dir, f'sub-{subj:03}')}")
+    print(f"selected empty room {prefix} ({gap / 3600:.1f} h from run {first_run})")
+    return prefix
+
+
+
+
+# %% instrumentation ----------------------------------------------------------
+
+def _io_counters():
+    """
+    Bytes read and written by the calling thread so far (from /proc/thread-self/io; None where unavailable, e.g.
+    macOS). Per thread, so that stages running at the same time on the writer and read-ahead threads are told apart.
+    """
+
+    try:
+        with open("/proc/thread-self/io", 'r') as stream:
+            counters = dict(line.split(": ") for line in stream.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (ru_maxrss is in bytes on macOS, kB on Linux)."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+
+
+class ConversionProfile:
+    """
+    Collects per-stage measurements of a conversion: wall time, CPU time, peak RSS and bytes read/written.
+    Bytes are counted at the read()/write() level, so reads served over NFS are included. Bytes and CPU time are
+    those of the thread running the stage, so that stages running concurrently on other threads are not counted;
+    the peak RSS is that of the whole process. Records from pool workers are merged in with `extend`.
+    """
+
+    def __init__(self, **details):
+        self.details = details
+        self.records = list()
+
+    @contextmanager
+    def stage(self, name, **details):
+        read0, written0 = _io_counters()
+        start, wall0, cpu0 = time.time(), time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            read1, written1 = _io_counters()
+            self.records.append({
+                **self.details,
+                **details,
+                "stage": name,
+                "start": start,
+                "wall_s": time.perf_counter() - wall0,
+                "cpu_s": time.thread_time() - cpu0,
+                "peak_rss_mb": _peak_rss_mb(),
+                "bytes_read": None if read0 is None else read1 - read0,
+                "bytes_written": None if written0 is None else written1 - written0,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            })
+
+    def extend(self, records):
+        self.records.extend({**self.details, **record} for record in records)
+
+    def print_summary(self):
+        print(f"\n{'stage':<18}{'wall (s)':>10}{'cpu (s)':>10}{'peak RSS (MB)':>15}{'read (MB)':>11}{'written (MB)':>14}")
+        for record in self.records:
+            read, written = record["bytes_read"], record["bytes_written"]
+            print(f"{record['stage']:<18}{record['wall_s']:>10.2f}{record['cpu_s']:>10.2f}{record['peak_rss_mb']:>15.1f}"
+                  f"{'' if read is None else f'{read / 1e6:.1f}':>11}{'' if written is None else f'{written / 1e6:.1f}':>14}")
+
+    def write_jsonl(self, fn):
+        """Appends one JSON line per stage to `fn`."""
+        with open(fn, 'a') as stream:
+            stream.write("".join(json.dumps(record) + "\n" for record in self.records))
+
+    def write_chrome_trace(self, fn):
+        """Writes the stages as complete events in the Chrome trace format (chrome://tracing, Perfetto)."""
+        events = [{
+            "name": record["stage"],
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["wall_s"] * 1e6,
+            "pid": record["pid"],
+            "tid": record["tid"],
+            "args": {key: value for key, value in record.items() if key not in ("stage", "start", "pid", "tid")},
+        } for record in self.records]
+        with open(fn, 'w') as stream:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, stream)
+
+
+
+
+def _profiled(func, *args):
+    """Runs func(*args, profile=...) in a pool worker and returns its result together with the stage records."""
+
+    profile = ConversionProfile()
+    return func(*args, profile=profile), profile.records
+
+
+
+
+def _raw_path(raw_dir, subj, prefix):
+    """Path of the Cerca FIF file for recording `prefix` of subject `subj` under `raw_dir`."""
+    return os.path.join(raw_dir, f"sub-{subj:03}", f"{prefix}_cMEG_Data", f"{prefix}_meg.fif")
+
+
+
+
+def _remove_bids_fif(bids_path):
+    """
+    Deletes an existing BIDS FIF output (including any split files) before it is rewritten.
+    mne_bids preloads the data it is about to overwrite, so clearing the old files first keeps writes streaming.
+    """
+
+    fif_path = bids_path.copy().update(datatype="meg", suffix="meg", extension=".fif")
+    for fn in glob.glob(str(fif_path.fpath)) + glob.glob(str(fif_path.fpath).replace("_meg.fif", "_split-*_meg.fif")):
+        os.remove(fn)
+
+
+
+
+@contextmanager
+def _file_lock(fn):
+    """Holds an exclusive advisory lock on `fn` (created if needed), shared by all processes on the host."""
+
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+
+
+def _bids_root_lock(bids_dir):
+    """
+    Holds an exclusive lock on the BIDS root while staged outputs are moved into it. Committing an output merges
+    rows into the shared participants.tsv and scans.tsv, so concurrent writers (batch workers converting
+    different subjects into the same root) must take turns.
+    """
+
+    return _file_lock(os.path.join(bids_dir, ".opm_format_bids.lock"))
+
+
+
+
+def _write_meg_bids(raw, bids_path, cfg, empty_room=None, qc_output=None):
+    """
+    Streams a (possibly concatenated) raw object that has not been preloaded to a BIDS FIF file.
+    Data are read from the source files and written in blocks of cfg.output.buffer_size_sec seconds,
+    and split into files of at most cfg.output.split_size, so peak memory is bounded by the block size
+    rather than by the session length. If qc_output (the final path of the output) is given, the QC statistics
+    of every block are accumulated as it is written (see ChannelQC) and saved to _qc_paths(cfg, qc_output).
+    With cfg.output.passthrough, the data buffers of the source files are copied without being decoded whenever
+    no sample changes (see _passthrough_fif); only the measurement info and annotations are written anew.
+    """
+
+    import mne_bids
+
+    _remove_bids_fif(bids_path)
+    raw.buffer_size_sec = cfg.output.buffer_size_sec
+    _set_precision(raw, cfg)
+
+    qc = None
+    if qc_output:
+        qc = ChannelQC(raw.info, cfg.recording_info.line_freq, psd_window_sec=cfg.qc.psd_window_sec,
+                       flat_window_sec=cfg.qc.flat_window_sec, flat_ptp=cfg.qc.flat_ptp)
+
+    # mne_bids writes FIF with raw.save, on a copy of raw (which rebinds this method to the copy)
+    if cfg.output.passthrough:
+        def _save(self, fname, fmt="single", split_size="2GB", split_naming="neuromag", overwrite=False, **kwargs):
+            try:
+                written = _passthrough_fif(self, fname, fmt, split_size, split_naming, qc=qc)
+            except (ImportError, TypeError, AttributeError, KeyError) as err:
+                # the passthrough relies on private mne APIs, which may change between mne versions
+                print(f"FIF passthrough failed ({type(err).__name__}: {err}): re-encoding the samples")
+                written = None
+                if qc is not None:
+                    qc.reset()
+            if written is None:
+                type(self).save(self, fname, fmt=fmt, split_size=split_size, split_naming=split_naming,
+                                overwrite=overwrite, **kwargs)
+
+        raw.save = types.MethodType(_save, raw)
+
+    # allow_preload skips mne_bids' check that raw matches its first source file, which concatenated runs fail.
+    # The data are still read lazily by raw.save().
+    with _tap_reads(raw, qc):
         mne_bids.write_raw_bids(
-            raw_empty_room,
-            emptyroom_bids_path,
+            raw,
+            bids_path,
             allow_preload=True,
             overwrite=True,
             events=None,
             format="FIF",
+            empty_room=empty_room,
+            extra_params={"split_size": cfg.output.split_size},
         )
-    
-    # Loop over runs for this subject -----------------------------------------
-    for rr, (run) in enumerate(runs):
-        print("\nrun: ", run, "--------\n")
-        
-        # Construct file path
-        fn = os.path.join(cfg['dirs']['data_dir'], f"sub-{subj:03}", f"{run}_cMEG_Data", f"{run}_meg.fif")
-        raw = mne.io.read_raw_fif(fn)
-        
-        
-        raw.info["line_freq"] = cfg["recording_info"]["line_freq"]
-        raw.info["subject_info"] = {
-            "id": int(subj),
-            "his_id": f"{subj:03}",
-            }
-        
-        
-        # Add events using triggers from cfg["trigger"]
-        if cfg["trigger"]["find_events"]:
-
-            print("\n\n\nFINDING EVENTS\n\n\n")
-            event_list = list()
-            for stim, old_trigger, new_trigger in zip(cfg["trigger"]["stim_id"][rr],
-                                                    cfg["trigger"]["old_trigger_id"][rr],
-                                                    cfg["trigger"]["new_trigger_id"][rr]):
-    
-                event = mne.find_events(raw, stim_channel=stim, min_duration=0.001)
-                event_list.append(mne.merge_events(event, [int(old_trigger)], new_trigger))
-            
-            events = np.concatenate(event_list, axis=0)
-            print("\nevents: ", events)
-            print("number of events: ", len(events), "\n")
-            
-            annot = mne.annotations_from_events(
-                events=events,
-                sfreq=raw.info["sfreq"],
-                event_desc=cfg["trigger"]["event_desc"]
-            )
-            raw.set_annotations(annot)
- 
-        raw_list.append(raw)
 
+    if cfg.output.passthrough:
+        del raw.save
+    if qc:
+        qc.save(*_qc_paths(cfg, qc_output))
 
-    # Concatenate raws for all runs of this subject
-    all_raw = mne.concatenate_raws(raw_list, preload=True, on_mismatch="raise")
 
-    recording_duration = all_raw.times[-1] - all_raw.times[0]
-    print(f"Recording duration for subject {subj}: {recording_duration:.2f} seconds")
 
-    # Rename annotations
-    if cfg["trigger"]["rename_annot"]:
-        all_raw.annotations.rename(cfg["trigger"]["event_desc"])
-    
-    # Write to BIDS -----------------------------------------------------------
-    bids_path = mne_bids.BIDSPath(
-        subject=f"{subj:03}",
-        session=cfg["session"]["session"],
-        task=task,
-        run="01",
-        root=cfg['dirs']['bids_dir'],
-    )
 
-    mne_bids.write_raw_bids(
-        all_raw,
-        bids_path,
-        allow_preload=True,
-        overwrite=True,
-        format="FIF",
-        empty_room=emptyroom_bids_path,
-    )
+def _set_precision(raw, cfg):
+    """
+    Sets the sample format that raw is written in (mne_bids writes FIF in raw.orig_format) to
+    cfg.output.precision. Runs concatenated from sources in different formats are written in double precision
+    unless a precision is given. For "short", each channel's calibration is set so that its peak absolute value
+    (found in one blockwise pass over the data) maps to the int16 range; stim channels keep a calibration of 1
+    while their codes fit, so that triggers are stored exactly. Only the calibrations written to the output
+    change: raw keeps reading its sources with their own.
+    """
 
+    import numpy as np
 
-    if anat_path:
+    precision = cfg.output.precision or (raw.orig_format if raw.orig_format != "unknown" else "double")
+    raw.orig_format = precision
+    if precision != "short":
+        return
 
-        anat_bids_path = mne_bids.BIDSPath(
-            subject=f"{subj:03}",
-            session=cfg["session"]["session"],
-            suffix="T1w",
-            root=cfg['dirs']['bids_dir'],
-        )
+    block = int(np.ceil(cfg.output.buffer_size_sec * raw.info["sfreq"]))
+    peak = np.zeros(len(raw.ch_names))
+    for start in range(0, raw.n_times, block):
+        data = raw.get_data(start=start, stop=min(start + block, raw.n_times))
+        np.maximum(peak, np.abs(data).max(axis=1), out=peak)
 
-        mne_bids.write_anat(
-            image=anat_path, 
-            bids_path=anat_bids_path, 
-            overwrite=True
-            )
-        
-        print('saved to anat path: ', anat_path)
-            
-    
-# %% main ---------------------------------------------------------------------
-if __name__ == "__main__":
+    for ch, kind, ch_peak in zip(raw.info["chs"], raw.get_channel_types(), peak):
+        if kind == "stim" and ch_peak <= 32767:
+            ch["cal"], ch["range"] = 1.0, 1.0
+        else:
+            ch["cal"], ch["range"] = (ch_peak / 32767 if ch_peak > 0 else 1.0), 1.0
+    print(f"writing {len(raw.ch_names)} channels as 16-bit integers (calibrated to each channel's peak)")
 
-    if len(sys.argv) > 1:
-        config_path = sys.argv[1]
-        print('config path: ', config_path)
-    else:
-        config_path = ""
 
-    print('config path: ', config_path)
-    cfg = set_bids_params(config_path)
-    bids_conversion(cfg)
 
-    print("\n\n\nDONE!\n\n\n")
+
+# %% FIF passthrough ----------------------------------------------------------
+
+_FIFF_FORMATS = {16: "short", 3: "int", 4: "single", 5: "double"}  # FIFFT_* type of the data buffers
+_FIFF_DTYPES = {16: ">i2", 3: ">i4", 4: ">f4", 5: ">f8"}
+
+
+def _passthrough_buffers(raw, fmt):
+    """
+    Locates the data buffers of every source file of raw that can be copied verbatim to an output in format
+    `fmt`: raw must not be preloaded, cropped, picked or projected, every buffer must be stored in `fmt`, and the
+    buffers must follow each other without skips.
+    Returns:
+        list of tuple: (filename, offset, n_bytes, [buffer tags]) per source file, or a str with the reason the
+            data have to be re-encoded.
+    """
+
+    import numpy as np
+
+    if raw.preload or not hasattr(raw, "_raw_extras") or not raw._raw_extras or "ent" not in raw._raw_extras[0]:
+        return "the data are not read lazily from FIF files"
+    if raw._projector is not None:
+        return "projectors are applied"
+    if not np.array_equal(raw._cals, [ch["cal"] * ch["range"] for ch in raw.info["chs"]]):
+        return "the channel calibrations change"
+
+    sources = list()
+    for fi, extra in enumerate(raw._raw_extras):
+        ents = extra["ent"]
+        if raw._last_samps[fi] - raw._first_samps[fi] + 1 != extra["bounds"][-1]:
+            return "a recording is cropped"
+        if not np.array_equal(raw._read_picks[fi], np.arange(extra["orig_nchan"])):
+            return "channels are selected"
+        if any(ent is None for ent in ents):
+            return "a recording has acquisition skips"
+        if any(_FIFF_FORMATS.get(ent.type) != fmt for ent in ents):
+            return f"a recording is not stored in {fmt}"
+        if any(ent.next != 0 or nxt.pos != ent.pos + 16 + ent.size for ent, nxt in zip(ents, ents[1:])):
+            return "the data buffers of a recording are not contiguous"
+        sources.append((str(extra["filename"]), ents[0].pos, ents[-1].pos + 16 + ents[-1].size - ents[0].pos, ents))
+    return sources
+
+
+
+
+def _copy_range(src, dst, offset, n_bytes):
+    """Copies bytes [offset, offset + n_bytes) of the open file src to the current position of dst, in the kernel."""
+
+    dst.flush()
+    while n_bytes > 0:
+        try:
+            n_copied = os.copy_file_range(src.fileno(), dst.fileno(), n_bytes, offset)
+        except (AttributeError, OSError):
+            n_copied = os.sendfile(dst.fileno(), src.fileno(), offset, n_bytes)
+        if n_copied == 0:
+            raise OSError(f"unexpected end of {src.name}")
+        offset += n_copied
+        n_bytes -= n_copied
+    dst.seek(0, os.SEEK_END)
+
+
+
+
+def _passthrough_fif(raw, fname, fmt, split_size, split_naming="bids", qc=None):
+    """
+    Writes raw to `fname` as raw.save would, but copies the data buffers of its source files verbatim instead of
+    decoding and re-encoding every sample: the measurement info and annotations of raw are written by mne, then
+    the buffers of each source file are copied in one kernel-side copy (copy_file_range, which can share extents
+    on file systems with reflinks, or sendfile) per output file. Outputs larger than split_size are split at
+    buffer boundaries, with the same names and links between parts as raw.save. If qc is given, the buffers are
+    instead read in Python so that they can also be passed to qc.update (still without re-encoding them).
+    Returns:
+        list of str: The written files, or None (without writing anything) if the data cannot be passed through
+            (see _passthrough_buffers). Parts written before an error are removed.
+    """
+
+    import io
+    import numpy as np
+    from mne._fiff.constants import FIFF
+    from mne._fiff.pick import pick_info
+    from mne._fiff.utils import _make_split_fnames
+    from mne._fiff.write import start_and_end_file, start_block, end_block, write_int, write_string, write_id
+    from mne.io.base import _write_raw_metadata
+
+    sources = _passthrough_buffers(raw, fmt)
+    if isinstance(sources, str):
+        print(f"FIF passthrough not possible ({sources}): re-encoding the samples")
+        return None
+
+    fname = str(getattr(fname, "fpath", fname))
+    split_size = _parse_size(split_size)
+    data_type = {name: code for code, name in _FIFF_FORMATS.items()}[fmt]
+    info = pick_info(raw.info, sel=None, copy=True)
+    for k, ch in enumerate(info["chs"]):
+        ch["scanno"] = k + 1
+
+    def _header(fid):
+        start_block(fid, FIFF.FIFFB_MEAS)
+        _write_raw_metadata(fid, info, data_type, False, raw.annotations)
+
+    # split the buffers into parts that fit in split_size, leaving room for the part links and end tags
+    header = io.BytesIO()
+    _header(header)
+    capacity = split_size - header.tell() - 2**20
+    parts, used = [[]], 0
+    for fn, _, _, ents in sources:
+        for ent in ents:
+            if used + 16 + ent.size > capacity and parts[-1]:
+                parts.append([])
+                used = 0
+            parts[-1].append((fn, ent))
+            used += 16 + ent.size
+    fnames = [os.path.join(os.path.dirname(fname), str(name))
+              for name in _make_split_fnames(os.path.basename(fname), len(parts), split_naming)]
+
+    cals = raw._cals[:, None]
+    data_kind = FIFF.FIFFB_IAS_RAW_DATA if info.get("maxshield", False) else FIFF.FIFFB_RAW_DATA
+    first_samp = raw.first_samp
+    handles = {fn: open(fn, "rb") for fn, _, _, _ in sources}
+    written = False
+    try:
+        for part_idx, (part, part_fn) in enumerate(zip(parts, fnames)):
+            with start_and_end_file(part_fn) as fid:
+                _header(fid)
+                start_block(fid, data_kind)
+                if first_samp != 0:
+                    write_int(fid, FIFF.FIFF_FIRST_SAMPLE, first_samp)
+                if part_idx > 0:
+                    start_block(fid, FIFF.FIFFB_REF)
+                    write_int(fid, FIFF.FIFF_REF_ROLE, FIFF.FIFFV_ROLE_PREV_FILE)
+                    write_string(fid, FIFF.FIFF_REF_FILE_NAME, os.path.basename(fnames[part_idx - 1]))
+                    if info["meas_id"] is not None:
+                        write_id(fid, FIFF.FIFF_REF_FILE_ID, info["meas_id"])
+                    write_int(fid, FIFF.FIFF_REF_FILE_NUM, part_idx - 1)
+                    end_block(fid, FIFF.FIFFB_REF)
+
+                # runs of consecutive buffers from the same source file are copied at once
+                start = 0
+                while start < len(part):
+                    fn, stop = part[start][0], start + 1
+                    while stop < len(part) and part[stop][0] == fn:
+                        stop += 1
+                    offset = part[start][1].pos
+                    n_bytes = part[stop - 1][1].pos + 16 + part[stop - 1][1].size - offset
+                    if qc is None:
+                        _copy_range(handles[fn], fid, offset, n_bytes)
+                    else:
+                        handles[fn].seek(offset)
+                        for _, ent in part[start:stop]:
+                            buffer = handles[fn].read(16 + ent.size)
+                            fid.write(buffer)
+                            samples = np.frombuffer(buffer, _FIFF_DTYPES[ent.type], offset=16)
+                            qc.update(samples.reshape(-1, len(info["ch_names"])).T * cals)
+                    first_samp += sum(ent.size // (np.dtype(_FIFF_DTYPES[ent.type]).itemsize * len(info["ch_names"]))
+                                      for _, ent in part[start:stop])
+                    start = stop
+
+                if part_idx < len(parts) - 1:
+                    start_block(fid, FIFF.FIFFB_REF)
+                    write_int(fid, FIFF.FIFF_REF_ROLE, FIFF.FIFFV_ROLE_NEXT_FILE)
+                    write_string(fid, FIFF.FIFF_REF_FILE_NAME, os.path.basename(fnames[part_idx + 1]))
+                    if info["meas_id"] is not None:
+                        write_id(fid, FIFF.FIFF_REF_FILE_ID, info["meas_id"])
+                    write_int(fid, FIFF.FIFF_REF_FILE_NUM, part_idx + 1)
+                    end_block(fid, FIFF.FIFFB_REF)
+                end_block(fid, data_kind)
+                end_block(fid, FIFF.FIFFB_MEAS)
+        written = True
+    finally:
+        for handle in handles.values():
+            handle.close()
+        if not written:  # leave no partial parts behind for a fallback to raw.save
+            for part_fn in fnames:
+                if os.path.exists(part_fn):
+                    os.remove(part_fn)
+
+    print(f"copied the data of {len(sources)} file(s) to {len(fnames)} file(s) without re-encoding")
+    return fnames
+
+
+
+
+# %% quality control ----------------------------------------------------------
+
+class ChannelQC:
+    """
+    Per-channel statistics of a recording, accumulated block by block from the data read while it is written, so
+    that QC does not need another pass over the file: mean, RMS, peak-to-peak, the fraction of `flat_window_sec`
+    windows whose peak-to-peak is at most `flat_ptp` (in channel units), and a Welch PSD (Hann windows of
+    `psd_window_sec` with 50% overlap, each demeaned) with the power within 1 Hz of each line noise harmonic.
+    """
+
+    def __init__(self, info, line_freq, psd_window_sec=2.0, flat_window_sec=1.0, flat_ptp=1e-15):
+        import numpy as np
+
+        self.ch_names = list(info["ch_names"])
+        self.ch_types = info.get_channel_types()
+        self.sfreq = info["sfreq"]
+        self.line_freq = line_freq
+        self.flat_ptp = flat_ptp
+        self.flat_window = max(1, int(round(flat_window_sec * self.sfreq)))
+        self.n_fft = max(2, int(round(psd_window_sec * self.sfreq)))
+        self.taper = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(self.n_fft) / self.n_fft)
+        self.reset()
+
+    def reset(self):
+        """Discards every block added so far (e.g. when a write is restarted)."""
+
+        import numpy as np
+
+        n_channels = len(self.ch_names)
+        self.position = 0
+        self.n_samples = 0
+        self.sum = np.zeros(n_channels)
+        self.sum_sq = np.zeros(n_channels)
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+
+        self.flat_tail = np.empty((n_channels, 0))
+        self.n_windows = 0
+        self.n_flat = np.zeros(n_channels, dtype=np.int64)
+
+        self.psd_tail = np.empty((n_channels, 0))
+        self.n_segments = 0
+        self.power = np.zeros((n_channels, self.n_fft // 2 + 1))
+
+    def update(self, data):
+        """Adds the next block of samples, shape (n_channels, n_samples), in physical units."""
+
+        import numpy as np
+
+        self.position += data.shape[1]
+        self.n_samples += data.shape[1]
+        self.sum += data.sum(axis=1)
+        self.sum_sq += np.einsum("ij,ij->i", data, data)
+        np.minimum(self.min, data.min(axis=1), out=self.min)
+        np.maximum(self.max, data.max(axis=1), out=self.max)
+
+        # flat windows, carrying the samples of an incomplete window over to the next block
+        buffer = np.concatenate([self.flat_tail, data], axis=1)
+        n_windows = buffer.shape[1] // self.flat_window
+        windows = buffer[:, :n_windows * self.flat_window].reshape(len(buffer), n_windows, self.flat_window)
+        self.n_flat += np.sum(np.ptp(windows, axis=2) <= self.flat_ptp, axis=1)
+        self.n_windows += n_windows
+        self.flat_tail = buffer[:, n_windows * self.flat_window:]
+
+        # Welch segments, carrying the samples of the next segment over to the next block
+        buffer = np.concatenate([self.psd_tail, data], axis=1)
+        step = self.n_fft // 2
+        starts = np.arange(0, buffer.shape[1] - self.n_fft + 1, step)
+        if len(starts):
+            segments = np.lib.stride_tricks.sliding_window_view(buffer, self.n_fft, axis=1)[:, starts]
+            segments = (segments - segments.mean(axis=2, keepdims=True)) * self.taper
+            self.power += np.sum(np.abs(np.fft.rfft(segments, axis=2)) ** 2, axis=1)
+            self.n_segments += len(starts)
+            buffer = buffer[:, starts[-1] + step:]
+        self.psd_tail = buffer
+
+    def result(self):
+        """
+        Returns:
+            dict: Arrays "mean", "rms", "ptp" and "flat_fraction" (per channel), "freqs" and "psd" (per channel and
+                frequency, in units**2/Hz), and "line_freqs" and "line_power" (per channel and harmonic, units**2).
+        """
+
+        import numpy as np
+
+        n_samples = max(self.n_samples, 1)
+        freqs = np.fft.rfftfreq(self.n_fft, 1 / self.sfreq)
+        psd = self.power / (max(self.n_segments, 1) * self.sfreq * np.sum(self.taper ** 2))
+        psd[:, 1:(self.n_fft + 1) // 2] *= 2  # one-sided: double all but DC (and Nyquist)
+
+        line_freqs = np.arange(self.line_freq, self.sfreq / 2, self.line_freq) if self.line_freq else np.empty(0)
+        bins = np.abs(freqs[None, :] - line_freqs[:, None]) <= max(1.0, freqs[1])
+        line_power = psd @ bins.T * freqs[1]
+
+        return {
+            "mean": self.sum / n_samples,
+            "rms": np.sqrt(self.sum_sq / n_samples),
+            "ptp": self.max - self.min,
+            "flat_fraction": self.n_flat / max(self.n_windows, 1),
+            "freqs": freqs,
+            "psd": psd,
+            "line_freqs": line_freqs,
+            "line_power": line_power,
+        }
+
+    def save(self, tsv_fn, npz_fn):
+        """Writes the per-channel summary (one row per channel) as TSV and every array (with the PSD) as NPZ."""
+
+        import numpy as np
+
+        result = self.result()
+        os.makedirs(os.path.dirname(tsv_fn), exist_ok=True)
+        with open(tsv_fn + ".tmp", "w", newline="") as stream:
+            writer = csv.writer(stream, delimiter="\t", lineterminator="\n")
+            writer.writerow(["name", "type", "mean", "rms", "ptp", "flat_fraction", "line_power"])
+            for cc, (name, kind) in enumerate(zip(self.ch_names, self.ch_types)):
+                writer.writerow([name, kind] + [f"{result[key][cc]:.6g}" for key in ("mean", "rms", "ptp")]
+                                + [f"{result['flat_fraction'][cc]:.4f}", f"{result['line_power'][cc].sum():.6g}"])
+        with open(npz_fn + ".tmp", "wb") as stream:
+            np.savez_compressed(stream, ch_names=self.ch_names, ch_types=self.ch_types, sfreq=self.sfreq,
+                                n_samples=self.n_samples, **result)
+        os.replace(tsv_fn + ".tmp", tsv_fn)
+        os.replace(npz_fn + ".tmp", npz_fn)
+        print(f"saved QC of {len(self.ch_names)} channels ({self.n_samples / self.sfreq:.1f} s): {tsv_fn}")
+
+
+
+
+@contextmanager
+def _tap_reads(raw, qc):
+    """
+    Passes every block of `raw` read in order from its first sample to qc.update, by wrapping the raw object's
+    _read_segment (through which raw.save reads the blocks it writes). Reads of a subset of channels or out of
+    order (e.g. by mne_bids) are not counted. Does nothing if qc is None.
+    """
+
+    if qc is None:
+        yield qc
+        return
+
+    read_segment = raw._read_segment
+
+    def _read_segment(start=0, stop=None, sel=None, data_buffer=None, **kwargs):
+        data = read_segment(start=start, stop=stop, sel=sel, data_buffer=data_buffer, **kwargs)
+        if start == qc.position and data.shape[0] == len(qc.ch_names):
+            qc.update(data)
+        return data
+
+    raw._read_segment = _read_segment
+    try:
+        yield qc
+    finally:
+        del raw._read_segment
+
+
+
+
+def _qc_paths(cfg, output_fn):
+    """QC files of a MEG output: its path within bids_dir, under `<bids_dir>/derivatives/opm_format_bids/qc`."""
+
+    base = os.path.join(cfg.dirs.bids_dir, "derivatives", "opm_format_bids", "qc",
+                        os.path.relpath(output_fn, cfg.dirs.bids_dir)).replace("_meg.fif", "_desc-qc")
+    return base + "_channels.tsv", base + "_psd.npz"
+
+
+
+
+# %% staged outputs -----------------------------------------------------------
+
+def _staging_root(cfg, key):
+    """
+    Creates an empty BIDS root in which output `key` is written before it is committed. It lives under the
+    derivatives of cfg.dirs.bids_dir, on the same file system, so that committing it is a rename. Anything left
+    there by an interrupted conversion is removed; the root is named after the task as well as the output, so
+    that conversions of other tasks of the session can run at the same time.
+    """
+
+    root = os.path.join(cfg.dirs.bids_dir, "derivatives", "opm_format_bids", "staging",
+                        f"sub-{cfg.session.ids:03}_ses-{cfg.session.session}_task-{cfg.session.task}_{key}")
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    return root
+
+
+
+
+def _link_staged(fn, bids_dir, staging_root):
+    """Hard links a committed BIDS file (and its split parts) into a staging root, e.g. the empty room a task refers to."""
+
+    for src in [fn] + sorted(glob.glob(fn.replace("_meg.fif", "_split-*_meg.fif"))):
+        if os.path.exists(src):
+            dst = os.path.join(staging_root, os.path.relpath(src, bids_dir))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            try:
+                os.link(src, dst)
+            except OSError:
+                os.symlink(src, dst)
+
+
+
+
+def _merge_tsv(staged_fn, fn, prefix=None):
+    """
+    Merges the rows of a staged BIDS table (e.g. participants.tsv, scans.tsv) into the committed one, keyed by
+    the first column: rows of the staged table replace committed rows with the same key and are otherwise
+    appended, and columns missing from either table are filled with "n/a". Committed rows whose key is a file
+    named with `prefix` (an earlier version of the staged output, e.g. before it was split) are dropped first.
+    The result is swapped in atomically.
+    """
+
+    def _read(path):
+        with open(path, 'r', newline="") as stream:
+            reader = csv.DictReader(stream, delimiter="\t")
+            return list(reader.fieldnames or []), list(reader)
+
+    staged_columns, staged_rows = _read(staged_fn)
+    columns, rows = _read(fn) if os.path.exists(fn) else (staged_columns, [])
+    columns += [column for column in staged_columns if column not in columns]
+    key = columns[0]
+
+    merged = {row[key]: row for row in rows if not (prefix and os.path.basename(row[key]).startswith(prefix))}
+    merged.update({row[key]: row for row in staged_rows})
+
+    with open(fn + ".tmp", 'w', newline="") as stream:
+        writer = csv.DictWriter(stream, fieldnames=columns, delimiter="\t", restval="n/a", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(merged.values())
+    os.replace(fn + ".tmp", fn)
+
+
+
+
+def _commit_staged(staging_root, bids_dir, output_fn):
+    """
+    Moves a staged output into the BIDS root, file by file with os.replace, under the BIDS root lock.
+        - Files of the output itself (named after `output_fn`, e.g. its FIF splits and sidecars) and the session's
+          coordsystem.json replace the committed ones; FIF splits of an earlier version that the new output no
+          longer has are removed afterwards.
+        - Shared tables (participants.tsv, scans.tsv) are merged row by row with _merge_tsv.
+        - Other shared files (dataset_description.json, README, participants.json) are only added if missing.
+        - Files linked in with _link_staged belong to other outputs and are left alone.
+    The staging root is removed once everything has been moved.
+    """
+
+    name = os.path.basename(output_fn)
+    prefix = name[:name.rindex("_")] + "_"  # e.g. sub-004_ses-01_task-noise_
+
+    with _bids_root_lock(bids_dir):
+        committed = set()
+        for dirpath, _, filenames in os.walk(staging_root):
+            for filename in sorted(filenames):
+                src = os.path.join(dirpath, filename)
+                dst = os.path.join(bids_dir, os.path.relpath(src, staging_root))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if filename.startswith(prefix) or filename.endswith("_coordsystem.json"):
+                    os.replace(src, dst)
+                    committed.add(dst)
+                elif filename.startswith(("sub-", ".")) and not filename.endswith(".tsv"):
+                    continue  # linked from another output, or a lock file
+                elif filename.endswith(".tsv"):
+                    _merge_tsv(src, dst, prefix)
+                elif not os.path.exists(dst):
+                    os.replace(src, dst)
+
+        if output_fn.endswith("_meg.fif"):
+            for fn in [output_fn] + glob.glob(output_fn.replace("_meg.fif", "_split-*_meg.fif")):
+                if fn not in committed and os.path.exists(fn):
+                    os.remove(fn)
+
+    shutil.rmtree(staging_root, ignore_errors=True)
+
+
+
+
+# %% read-ahead ---------------------------------------------------------------
+
+def _read_ahead(fn, stop, block_size=16 * 2**20):
+    """
+    Reads `fn` sequentially into a reused buffer, which leaves its bytes in the page cache without holding them in
+    this process. Stops early if `stop` is set.
+    """
+
+    with open(fn, 'rb', buffering=0) as stream:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(block_size)
+        while stream.readinto(buffer) and not stop.is_set():
+            pass
+
+
+
+
+class RunPrefetcher:
+    """
+    Producer/consumer read-ahead over the source files of a session. A background thread reads the upcoming runs
+    while the current one is processed (header read, stim decoding), and hands them over in order through a queue.
+    At most `depth` runs wait in the queue, and the bytes that have been read ahead but not yet released by the
+    consumer are kept under `budget_mb` (one run is always allowed), so that the read-ahead cannot evict runs that
+    are still being processed from the page cache. With depth=0 the files are yielded without reading ahead.
+    Read-ahead is best effort: a file that fails to read is still yielded, so that the consumer reports the error.
+    Usage:
+        with RunPrefetcher(fns, depth=1) as prefetcher:
+            for fn in prefetcher:
+                ...  # fn has been read ahead; it is released at the next iteration
+    """
+
+    def __init__(self, fns, depth=1, budget_mb=2048, profile=None, runs=None):
+        self.fns = list(fns)
+        self.depth = depth
+        self.budget = budget_mb * 1e6
+        self.profile = profile
+        self.runs = runs or self.fns
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._pending = 0  # bytes read ahead and not yet released
+        self._released = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._produce, name="run-prefetch", daemon=True)
+            self._thread.start()
+
+    def _produce(self):
+        for fn, run in zip(self.fns, self.runs):
+            try:
+                size = os.path.getsize(fn)
+            except OSError:
+                size = 0
+            with self._released:
+                self._released.wait_for(
+                    lambda: self._stop.is_set() or self._pending == 0 or self._pending + size <= self.budget)
+                if self._stop.is_set():
+                    return
+                self._pending += size
+            try:
+                if self.profile is not None:
+                    with self.profile.stage("prefetch", run=run):
+                        _read_ahead(fn, self._stop)
+                else:
+                    _read_ahead(fn, self._stop)
+            except OSError as err:
+                print(f"read-ahead failed for {fn}: {err}")
+            while not self._stop.is_set():
+                try:
+                    self._queue.put((fn, size), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def __iter__(self):
+        if self._thread is None:
+            yield from self.fns
+            return
+        for _ in self.fns:
+            fn, size = self._queue.get()
+            try:
+                yield fn
+            finally:
+                with self._released:
+                    self._pending -= size
+                    self._released.notify_all()
+
+    def close(self):
+        self._stop.set()
+        with self._released:
+            self._released.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+
+def select_channels(ch_names, ch_types, keep=None, drop=()):
+    """
+    Applies a keep/drop channel policy (cfg.input.keep_channels / drop_channels). Each entry is a channel name, a
+    glob on channel names (e.g. "STI*") or an mne channel type (e.g. "mag", "ref_meg", "misc").
+    Parameters:
+        ch_names (list of str): Channel names, in file order.
+        ch_types (list of str): Channel types, as returned by info.get_channel_types().
+        keep (list of str): Channels to keep; None keeps every channel.
+        drop (list of str): Channels to remove from those kept.
+    Returns:
+        list of str: The selected channel names, in file order.
+    """
+
+    def _matches(name, kind, patterns):
+        return any(pattern == kind or fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    return [name for name, kind in zip(ch_names, ch_types)
+            if (keep is None or _matches(name, kind, keep)) and not _matches(name, kind, drop)]
+
+
+
+
+def _pick_channels(raw, cfg):
+    """
+    Restricts a raw object that has not been preloaded to the channels selected by cfg.input, so that the
+    other channels are neither read into memory nor written. Returns raw (picked in place).
+    """
+
+    if cfg.input.keep_channels is None and not cfg.input.drop_channels:
+        return raw
+
+    picks = select_channels(raw.ch_names, raw.get_channel_types(), cfg.input.keep_channels, cfg.input.drop_channels)
+    if not picks:
+        raise ValueError(f"input.keep_channels / drop_channels select no channels of {raw.filenames[0]}")
+    print(f"keeping {len(picks)} of {len(raw.ch_names)} channels")
+    return raw.pick(picks)
+
+
+
+
+def _load_emptyroom(cfg, profile=None):
+    """
+    Reads the empty room file named by cfg.session.emptyroom_prefix, selects the same channels as for the runs
+    (see select_channels) and sets its line frequency.
+    Parameters:
+        cfg (BidsConfig): The configuration (see bids_conversion).
+        profile (ConversionProfile): Records the "emptyroom_read" stage if given.
+    Returns:
+        mne.io.Raw: The (not preloaded) empty room raw data.
+    """
+
+    import mne
+
+    subj = cfg.session.ids
+    emptyroom = cfg.session.emptyroom_prefix
+
+    fn_empty_room = _raw_path(cfg.dirs.emptyroom_dir, subj, emptyroom)
+
+    profile = profile or ConversionProfile()
+    with profile.stage("emptyroom_read", run=emptyroom):
+        raw_empty_room = mne.io.read_raw_fif(fn_empty_room)
+    _pick_channels(raw_empty_room, cfg)
+    raw_empty_room.info["line_freq"] = cfg.recording_info.line_freq
+
+    return raw_empty_room
+
+
+
+
+def _read_stim_data(raw, stim_channels, block_sec):
+    """
+    Reads only the stim channels of a raw object that has not been preloaded, in blocks of `block_sec` seconds.
+    All stim channels are read in a single pass over the file, and only one block of the other channels is held
+    in memory at a time, so event finding never loads the full recording.
+    Returns:
+        ndarray: Stim channel samples, shape (len(stim_channels), raw.n_times).
+    """
+
+    import mne
+    import numpy as np
+
+    picks = mne.pick_channels(raw.ch_names, stim_channels, ordered=True)
+    block = int(np.ceil(block_sec * raw.info["sfreq"]))
+
+    data = np.empty((len(picks), raw.n_times))
+    for start in range(0, raw.n_times, block):
+        stop = min(start + block, raw.n_times)
+        data[:, start:stop] = raw.get_data(picks=picks, start=start, stop=stop)
+
+    return data
+
+
+
+
+def decode_triggers(stim_data, first_samp, stim_rows, old_ids, new_ids, min_samples=0, shortest_event=2):
+    """
+    Finds trigger onsets on all stim channels in one pass and applies the old -> new trigger remapping.
+    This is a vectorised equivalent of calling mne.find_events (consecutive="increasing") on each stim channel,
+    then mne.merge_events for each (stim, old, new) entry of cfg.trigger, and concatenating the results.
+    Parameters:
+        stim_data (ndarray): Stim channel samples, shape (n_stim, n_times).
+        first_samp (int): First sample of the recording, added to the event samples.
+        stim_rows (list of int): For each remapping entry, the row of stim_data it applies to.
+        old_ids (list of int): For each remapping entry, the trigger code to replace.
+        new_ids (list of int): For each remapping entry, the code that replaces it.
+        min_samples (float): Minimum trigger duration in samples, as find_events' min_duration * sfreq.
+        shortest_event (int): Minimum number of samples between events on a channel, as in find_events.
+    Returns:
+        ndarray: Events, shape (n_events, 3), sorted by sample. As with the per-channel loop, each remapping entry
+            contributes all events of its stim channel.
+    Raises:
+        ValueError: If events on a channel are closer together than `shortest_event` samples.
+    """
+
+    import numpy as np
+
+    data = np.abs(stim_data.astype(np.int64))
+    n_stim, n_times = data.shape
+
+    # every step on every channel, ordered by channel then sample
+    rows, cols = np.nonzero(np.diff(data, axis=1))
+    pre, post = data[rows, cols], data[rows, cols + 1]
+    samples = cols + 1 + first_samp
+
+    # channels that end on a trigger get a final step back to zero
+    pad = np.flatnonzero((np.bincount(rows, minlength=n_stim) > 0) & (data[:, -1] != 0))
+    rows = np.r_[rows, pad]
+    samples = np.r_[samples, np.full(len(pad), n_times + first_samp)]
+    pre = np.r_[pre, data[pad, -1]]
+    post = np.r_[post, np.zeros(len(pad), dtype=np.int64)]
+    order = np.lexsort((samples, rows))
+    rows, samples, pre, post = rows[order], samples[order], pre[order], post[order]
+
+    # merge steps that are shorter than min_samples into the following step
+    merge = int(min_samples // 1) - (int(min_samples // 1) == min_samples) if min_samples > 0 else 0
+    if merge > 0 and len(rows):
+        short = (np.diff(samples) <= merge) & (rows[1:] == rows[:-1])
+        where = np.flatnonzero(short)
+        pre[where + 1] = pre[where]
+        keep = np.r_[~short, True] & (pre != post)
+        rows, samples, pre, post = rows[keep], samples[keep], pre[keep], post[keep]
+
+    # onsets are increasing steps; drop a channel's last onset if no offset follows it
+    onset = post > pre
+    offset = (onset | (post == 0)) & (pre > 0)
+    step_idx = np.arange(len(rows))
+    last_onset = np.full(n_stim, -1)
+    last_offset = np.full(n_stim, -1)
+    np.maximum.at(last_onset, rows[onset], step_idx[onset])
+    np.maximum.at(last_offset, rows[offset], step_idx[offset])
+    onset[last_onset[(last_onset > last_offset) & (last_offset >= 0)]] = False
+    onset &= last_offset[rows] >= 0
+
+    events = np.c_[samples, pre, post][onset]
+    ev_rows = rows[onset]
+
+    same_row = (ev_rows[1:] == ev_rows[:-1]) & np.isin(ev_rows[1:], stim_rows)
+    n_short = np.sum((np.diff(events[:, 0]) < shortest_event) & same_row)
+    if n_short > 0:
+        raise ValueError(f"You have {n_short} events shorter than the shortest_event. These are very unusual and "
+                         "you may want to set min_duration to a larger value.")
+
+    # gather every entry's channel events and remap them through a lookup table of the observed codes
+    row_counts = np.bincount(ev_rows, minlength=n_stim)
+    row_start = np.cumsum(row_counts) - row_counts
+    counts = row_counts[stim_rows]
+    entry = np.repeat(np.arange(len(stim_rows)), counts)
+    entry_start = np.cumsum(counts) - counts
+    event_idx = np.repeat(row_start[stim_rows] - entry_start, counts) + np.arange(counts.sum())
+
+    codes, code_idx = np.unique(events[:, 1:], return_inverse=True)
+    remap = codes[None, :] == np.asarray(old_ids)[:, None]
+    lut = np.where(remap, np.asarray(new_ids)[:, None], codes[None, :])
+
+    out = events[event_idx]
+    out[:, 1:] = lut[entry[:, None], code_idx.reshape(-1, 2)[event_idx]]
+
+    return out[np.argsort(out[:, 0], kind="stable")]
+
+
+
+
+def annotations_from_codes(events, sfreq, event_desc, rename=None):
+    """
+    Builds the annotations of decoded events in one go, without a Python string per event: the descriptions are
+    looked up per distinct trigger code, and gathered with the events' indices into that table. Equivalent to
+    mne.annotations_from_events (events whose code is not in `event_desc` are dropped; with an empty `event_desc`,
+    the codes themselves are the descriptions) followed by Annotations.rename(rename), except that `rename` entries
+    that match no description are ignored, as its integer keys are the codes of `event_desc`.
+    Parameters:
+        events (ndarray): Events, shape (n_events, 3), as returned by decode_triggers.
+        sfreq (float): Sampling frequency, to convert samples to onsets.
+        event_desc (dict): Descriptions of the trigger codes.
+        rename (dict): Description renaming to apply to the code table (cfg.trigger.event_desc if rename_annot).
+    Returns:
+        mne.Annotations: Zero-duration annotations relative to the first sample (orig_time None).
+    Raises:
+        ValueError: If no event has a code in `event_desc`.
+    """
+
+    import numpy as np
+    import mne
+
+    codes, code_idx = np.unique(events[:, 2], return_inverse=True)
+    names = [event_desc.get(int(code)) if event_desc else str(code) for code in codes]
+    if rename:
+        names = [name if name is None else str(rename.get(name, name)) for name in names]
+    keep = np.array([name is not None for name in names], dtype=bool)
+    if not keep[code_idx].any():
+        raise ValueError("Could not find any of the events you specified.")
+
+    # index of each event's description among the kept codes
+    lut = np.cumsum(keep) - 1
+    selected = keep[code_idx]
+    descriptions = np.asarray([name for name in names if name is not None], dtype=np.dtypes.StringDType())
+    return mne.Annotations(
+        onset=events[selected, 0] / sfreq,
+        duration=0.0,
+        description=descriptions[lut[code_idx[selected]]],
+    )
+
+
+
+
+def rename_annotations(annotations, mapping, missing_ok=False):
+    """
+    Renames annotation descriptions in place, as Annotations.rename but with one vectorised comparison per entry
+    of `mapping` rather than a Python string per annotation.
+    Parameters:
+        annotations (mne.Annotations): The annotations to rename.
+        mapping (dict): Old to new descriptions.
+        missing_ok (bool): Skip the keys of `mapping` that match no annotation (e.g. in one run of a session)
+            instead of raising.
+    Returns:
+        mne.Annotations: The renamed annotations.
+    Raises:
+        ValueError: If a key of `mapping` is not the description of any annotation (unless missing_ok).
+    """
+
+    import numpy as np
+
+    descriptions = np.asarray(annotations.description)
+    renamed = descriptions.astype(object)  # older mne stores fixed-width <U, which would truncate longer names
+    missing = set()
+    for old, new in mapping.items():
+        matches = descriptions == str(old)
+        if not matches.any():
+            missing.add(old)
+        renamed[matches] = str(new)
+    if missing and not missing_ok:
+        raise ValueError(f"Invalid annotation description(s) {missing} not present in the data")
+    annotations.description = renamed
+    return annotations
+
+
+
+
+def _load_run(cfg, rr, run, profile=None):
+    """
+    Reads a single run, sets its line frequency and subject info, and optionally finds its events. Its channels
+    are then restricted to those selected by cfg.input (see select_channels), so that stim channels can be
+    decoded and still dropped from the output.
+    Kept at module level so that it can be dispatched to a process pool by bids_conversion.
+    Parameters:
+        cfg (BidsConfig): The configuration (see bids_conversion).
+        rr (int): Index of the run, used to select the per-run trigger settings.
+        run (str): Run prefix.
+        profile (ConversionProfile): Records the "run_read" and "events" stages if given.
+    Returns:
+        mne.io.Raw: The (not preloaded) raw data, with annotations set if events were found.
+    """
+
+    import mne
+
+    subj = cfg.session.ids
+    print("\nrun: ", run, "--------\n")
+
+    # Construct file path
+    fn = _raw_path(cfg.dirs.data_dir, subj, run)
+    profile = profile or ConversionProfile()
+    with profile.stage("run_read", run=run):
+        raw = mne.io.read_raw_fif(fn)
+
+
+    raw.info["line_freq"] = cfg.recording_info.line_freq
+    raw.info["subject_info"] = {
+        "id": int(subj),
+        "his_id": f"{subj:03}",
+        }
+
+
+    # Add events using triggers from cfg.trigger
+    if cfg.trigger.find_events:
+
+        print("\n\n\nFINDING EVENTS\n\n\n")
+        with profile.stage("events", run=run):
+            stim_channels = list(dict.fromkeys(cfg.trigger.stim_id[rr]))
+            stim_data = _read_stim_data(raw, stim_channels, cfg.output.buffer_size_sec)
+
+            events = decode_triggers(
+                stim_data,
+                raw.first_samp,
+                stim_rows=[stim_channels.index(stim) for stim in cfg.trigger.stim_id[rr]],
+                old_ids=[int(old_trigger) for old_trigger in cfg.trigger.old_trigger_id[rr]],
+                new_ids=[int(new_trigger) for new_trigger in cfg.trigger.new_trigger_id[rr]],
+                min_samples=0.001 * raw.info["sfreq"],
+            )
+            print("\nevents: ", events)
+            print("number of events: ", len(events), "\n")
+
+            annot = annotations_from_codes(
+                events,
+                raw.info["sfreq"],
+                cfg.trigger.event_desc,
+                rename=cfg.trigger.event_desc if cfg.trigger.rename_annot else None,
+            )
+            raw.set_annotations(annot)
+
+    return _pick_channels(raw, cfg)
+
+
+
+
+def _write_run(cfg, rr, profile=None):
+    """
+    Reads, annotates and writes run `rr` as its own BIDS output `run-<rr + 1>` (cfg.output.separate_runs), staged
+    and committed like the other outputs and associated with the empty room, which must already be in bids_dir.
+    Kept at module level so that each run can be dispatched to a process pool worker by bids_conversion.
+    Returns:
+        str: The output key, "run-NN".
+    """
+
+    import mne_bids
+
+    key = f"run-{rr + 1:02}"
+    run = cfg.session.run_prefix[rr]
+    outputs = _output_paths(cfg)
+    profile = profile or ConversionProfile()
+
+    raw = _load_run(cfg, rr, run, profile=profile)
+    if cfg.trigger.rename_annot and not cfg.trigger.find_events:  # decoded events are named when loaded
+        with profile.stage("rename", run=run):
+            # a run may lack some of the session's descriptions; preflight checks them against the whole session
+            rename_annotations(raw.annotations, cfg.trigger.event_desc, missing_ok=True)
+
+    staging_root = _staging_root(cfg, key)
+    bids_path = mne_bids.BIDSPath(
+        subject=f"{cfg.session.ids:03}",
+        session=cfg.session.session,
+        task=cfg.session.task,
+        run=f"{rr + 1:02}",
+        root=staging_root,
+    )
+    with profile.stage("bids_write", run=run):
+        empty_room = None
+        if cfg.session.emptyroom_prefix:
+            # mne_bids needs the associated empty room under the same root
+            _link_staged(outputs["emptyroom"], cfg.dirs.bids_dir, staging_root)
+            empty_room = mne_bids.BIDSPath(**_emptyroom_entities(cfg), datatype="meg", root=staging_root)
+        _write_meg_bids(raw, bids_path, cfg, empty_room=empty_room,
+                        qc_output=outputs[key] if cfg.qc.enabled else None)
+        _commit_staged(staging_root, cfg.dirs.bids_dir, outputs[key])
+
+    return key
+
+
+
+
+# %% preflight ----------------------------------------------------------------
+
+_BYTES_PER_SAMPLE = {"short": 2, "int": 4, "single": 4, "double": 8}
+
+
+def _read_header(fn):
+    """Reads the measurement info and sample count of a FIF file, without reading any data buffers."""
+
+    import mne
+
+    raw = mne.io.read_raw_fif(fn, preload=False, verbose="error")
+    return {
+        "fn": fn,
+        "info": raw.info,
+        "n_times": int(raw.n_times),
+        "format": raw.orig_format,
+        "annotations": raw.annotations.description,
+    }
+
+
+
+
+def preflight(cfg, runs=True, emptyroom=True, n_jobs=1):
+    """
+    Checks that the recordings of a session can be converted together, reading only their headers. The runs must
+    agree in sampling rate, channel names and device-to-head transform (which concatenate_raws would otherwise
+    only reject after every run had been loaded), and contain the stim channels named in cfg.trigger when
+    events are to be found, and be annotated with every description that cfg.trigger renames. The empty room is compared with the first run, and differences are reported as
+    warnings. The output sizes and the peak memory of the conversion are estimated from the headers.
+    Parameters:
+        cfg (BidsConfig): The configuration (see bids_conversion).
+        runs (bool): Check the task runs. Defaults to True.
+        emptyroom (bool): Check the empty room recording, if one is configured. Defaults to True.
+        n_jobs (int): Number of runs loaded at once, used for the memory estimate. Defaults to 1.
+    Returns:
+        dict: With keys "runs" and "emptyroom" (headers: fn, info, n_times, format, annotation descriptions and the
+            ch_names kept by cfg.input), "warnings",
+            "output_bytes" (per output), "n_splits" (per output) and "peak_memory_mb". With cfg.output.separate_runs,
+            runs that differ in sampling rate, channels or head position are reported as warnings, not errors.
+    Raises:
+        ValueError: Listing every incompatibility found.
+    """
+
+    import numpy as np
+
+    subj = cfg.session.ids
+    errors, warnings = list(), list()
+    report = {"runs": [], "emptyroom": None, "warnings": warnings, "output_bytes": {}, "n_splits": {}}
+
+    def _header(fn):
+        try:
+            return _read_header(fn)
+        except Exception as err:
+            errors.append(f"cannot read the header of {fn}: {err}")
+
+    if runs:
+        report["runs"] = [_header(_raw_path(cfg.dirs.data_dir, subj, run)) for run in cfg.session.run_prefix]
+    if emptyroom and cfg.session.emptyroom_prefix:
+        report["emptyroom"] = _header(_raw_path(cfg.dirs.emptyroom_dir, subj, cfg.session.emptyroom_prefix))
+    if errors:
+        raise ValueError("preflight failed:\n  - " + "\n  - ".join(errors))
+
+    # channels that are kept (see select_channels); only these have to agree between recordings
+    for header in report["runs"] + ([report["emptyroom"]] if report["emptyroom"] else []):
+        header["ch_names"] = select_channels(header["info"]["ch_names"], header["info"].get_channel_types(),
+                                             cfg.input.keep_channels, cfg.input.drop_channels)
+        if not header["ch_names"]:
+            errors.append(f"input.keep_channels / drop_channels select no channels of {header['fn']}")
+
+    headers = report["runs"]
+    first = headers[0] if headers else None
+    if first and cfg.input.keep_channels:
+        types = set(first["info"].get_channel_types())
+        for pattern in cfg.input.keep_channels:
+            if pattern not in types and not fnmatch.filter(first["info"]["ch_names"], pattern):
+                warnings.append(f"input.keep_channels entry {pattern!r} matches no channel")
+    # runs written separately do not have to match each other
+    mismatches = warnings if cfg.output.separate_runs else errors
+    for rr, (run, header) in enumerate(zip(cfg.session.run_prefix, headers)):
+        info = header["info"]
+        if info["sfreq"] != first["info"]["sfreq"]:
+            mismatches.append(f"run {run}: sfreq {info['sfreq']} differs from {first['info']['sfreq']} in run "
+                          f"{cfg.session.run_prefix[0]}")
+        if header["ch_names"] != first["ch_names"]:
+            missing = sorted(set(first["ch_names"]) - set(header["ch_names"]))
+            extra = sorted(set(header["ch_names"]) - set(first["ch_names"]))
+            mismatches.append(f"run {run}: channels differ from run {cfg.session.run_prefix[0]} (missing: {missing}, "
+                          f"extra: {extra}{', order differs' if not missing and not extra else ''})")
+        trans, first_trans = info["dev_head_t"], first["info"]["dev_head_t"]
+        if (trans is None) != (first_trans is None) or (
+                trans is not None and not np.allclose(trans["trans"], first_trans["trans"])):
+            mismatches.append(f"run {run}: dev_head_t differs from run {cfg.session.run_prefix[0]}")
+        if cfg.trigger.find_events:
+            missing = sorted(set(cfg.trigger.stim_id[rr]) - set(info["ch_names"]))
+            if missing:
+                errors.append(f"run {run}: stim channels {missing} not found")
+        if rr and info["meas_date"] and headers[rr - 1]["info"]["meas_date"] \
+                and info["meas_date"] < headers[rr - 1]["info"]["meas_date"]:
+            warnings.append(f"run {run} was recorded before the run listed ahead of it")
+    if headers and cfg.trigger.rename_annot and not cfg.trigger.find_events:
+        descriptions = set().union(*(set(header["annotations"]) for header in headers))
+        missing = [old for old in cfg.trigger.event_desc if str(old) not in descriptions]
+        if missing:
+            errors.append(f"trigger.event_desc renames {missing}, which no run of the session is annotated with")
+
+    emptyroom_header = report["emptyroom"]
+    if emptyroom_header and cfg.output.shared_emptyroom:
+        # mne_bids rejects an empty room session other than the UTC date of its meas_date, but only once it writes it
+        meas_date = emptyroom_header["info"]["meas_date"]
+        session = _emptyroom_entities(cfg)["session"]
+        if meas_date is None or f"{meas_date.astimezone(datetime.timezone.utc):%Y%m%d}" != session:
+            errors.append(f"empty room {cfg.session.emptyroom_prefix}: session label ses-{session} does not match its "
+                          f"meas_date {meas_date} (UTC), which mne_bids requires of sub-emptyroom")
+    if emptyroom_header and first:
+        if emptyroom_header["info"]["sfreq"] != first["info"]["sfreq"]:
+            warnings.append(f"empty room sfreq {emptyroom_header['info']['sfreq']} differs from the runs "
+                            f"({first['info']['sfreq']})")
+        if set(emptyroom_header["ch_names"]) != set(first["ch_names"]):
+            warnings.append("empty room channels differ from the runs")
+
+    if errors:
+        raise ValueError("preflight failed:\n  - " + "\n  - ".join(errors))
+
+    # Output sizes: one sample per channel and time point in the source format, plus the measurement info of each
+    # file. mne starts a new split 1 MB before split_size is reached.
+    split_size = _parse_size(cfg.output.split_size)
+    outputs = {"emptyroom": [emptyroom_header] if emptyroom_header else []}
+    if cfg.output.separate_runs:
+        outputs.update({f"run-{rr + 1:02}": [header] for rr, header in enumerate(headers)})
+    else:
+        outputs["task"] = headers
+    for key, parts in outputs.items():
+        if parts:
+            n_bytes = sum(len(h["ch_names"]) * h["n_times"]
+                          * _BYTES_PER_SAMPLE.get(cfg.output.precision or h["format"], 8)
+                          for h in parts)
+            report["n_splits"][key] = max(1, int(np.ceil(n_bytes / (split_size - 2**20))))
+            report["output_bytes"][key] = n_bytes + report["n_splits"][key] * 2**16
+
+    # Peak memory: the float64 stim arrays of the runs loaded at once, or one write block (plus its conversion) per
+    # run written at once
+    peak = 0.0
+    if headers:
+        sfreq, n_channels = first["info"]["sfreq"], len(first["ch_names"])
+        n_writes = min(max(n_jobs, 1), len(headers)) if cfg.output.separate_runs else 1
+        peak = 2 * cfg.output.buffer_size_sec * sfreq * n_channels * 8 * n_writes
+        if cfg.trigger.find_events:
+            stim = sorted((len(set(cfg.trigger.stim_id[rr])) * h["n_times"] * 8 for rr, h in enumerate(headers)),
+                          reverse=True)
+            peak = max(peak, sum(stim[:max(n_jobs, 1)]))
+    report["peak_memory_mb"] = peak / 1e6
+
+    return report
+
+
+
+
+def _print_preflight(report):
+    headers = report["runs"] + ([report["emptyroom"]] if report["emptyroom"] else [])
+    for header in headers:
+        info = header["info"]
+        print(f"{os.path.basename(header['fn']):<32}{info['sfreq']:>8.0f} Hz{len(header['ch_names']):>6} ch"
+              f"{header['n_times'] / info['sfreq']:>10.1f} s  {header['format']}")
+    for key, n_bytes in report["output_bytes"].items():
+        print(f"{key} output: ~{n_bytes / 1e6:.1f} MB in {report['n_splits'][key]} file(s)")
+    print(f"estimated peak data memory: {report['peak_memory_mb']:.1f} MB")
+    for warning in report["warnings"]:
+        print(f"WARNING: {warning}")
+
+
+
+
+# %% conversion cache ---------------------------------------------------------
+
+def _output_paths(cfg):
+    """
+    Files that bids_conversion writes for cfg, keyed by output: "emptyroom", then "task" (the concatenated runs)
+    or, with cfg.output.separate_runs, "run-01" to "run-NN", and "anat".
+    """
+
+    subj = cfg.session.ids
+    session = cfg.session.session
+    meg_dir = os.path.join(cfg.dirs.bids_dir, f"sub-{subj:03}", f"ses-{session}", "meg")
+
+    outputs = dict()
+    if cfg.session.emptyroom_prefix:
+        entities = _emptyroom_entities(cfg)
+        if cfg.output.shared_emptyroom:
+            outputs["emptyroom"] = os.path.join(
+                cfg.dirs.bids_dir, "sub-emptyroom", f"ses-{entities['session']}", "meg",
+                f"sub-emptyroom_ses-{entities['session']}_task-noise_acq-{entities['acquisition']}_meg.fif")
+        else:
+            outputs["emptyroom"] = os.path.join(meg_dir, f"sub-{subj:03}_ses-{session}_task-noise_meg.fif")
+    if cfg.output.separate_runs:
+        for rr in range(len(cfg.session.run_prefix)):
+            outputs[f"run-{rr + 1:02}"] = os.path.join(
+                meg_dir, f"sub-{subj:03}_ses-{session}_task-{cfg.session.task}_run-{rr + 1:02}_meg.fif")
+    else:
+        outputs["task"] = os.path.join(meg_dir, f"sub-{subj:03}_ses-{session}_task-{cfg.session.task}_run-01_meg.fif")
+    if cfg.dirs.anat_path:
+        outputs["anat"] = os.path.join(cfg.dirs.bids_dir, f"sub-{subj:03}", f"ses-{session}", "anat",
+                                       f"sub-{subj:03}_ses-{session}_T1w.nii.gz")
+    return outputs
+
+
+
+
+def _read_meas_date(fn):
+    """
+    meas_date of a FIF file as a UTC datetime, read from the FIFF_MEAS_DATE tag of its measurement info without
+    importing mne (the tags are scanned from the start of the file up to the first data buffer). None if the
+    measurement info has no such tag, in which case mne falls back to the measurement id.
+    """
+
+    blocks = list()
+    with open(fn, 'rb') as stream:
+        while True:
+            head = stream.read(16)
+            if len(head) < 16:
+                return None
+            kind, _, size, next_pos = struct.unpack(">iiii", head)
+            if kind == 204 and blocks[-1:] == [101]:  # FIFF_MEAS_DATE in FIFFB_MEAS_INFO
+                secs, usecs = struct.unpack(">ii", stream.read(8))
+                return datetime.datetime.fromtimestamp(secs, datetime.timezone.utc) + datetime.timedelta(microseconds=usecs)
+            if kind == 300:  # FIFF_DATA_BUFFER: the measurement info is behind us
+                return None
+            if kind == 104:  # FIFF_BLOCK_START, with the kind of the block
+                blocks.append(struct.unpack(">i", stream.read(4))[0])
+                size -= 4
+            elif kind == 105 and blocks:  # FIFF_BLOCK_END
+                blocks.pop()
+            if next_pos > 0:
+                stream.seek(next_pos)
+            elif next_pos == 0:
+                stream.seek(size, 1)
+            else:
+                return None
+
+
+
+
+def _emptyroom_entities(cfg):
+    """
+    BIDS entities of cfg's empty room output. By default it is stored with the subject, as task "noise" of their
+    session. With cfg.output.shared_emptyroom it is stored once for all subjects, under the BIDS empty room
+    subject `sub-emptyroom/ses-<YYYYMMDD>` with `acq-<HHMMSS>`, the UTC date and time of the recording's meas_date
+    (mne_bids requires the session to be the UTC date, which is a day after the local date of a recording made
+    in the evening west of Greenwich). The YYYYMMDD_HHMMSS prefix, in local time, is only used if the header has no
+    meas_date.
+    """
+
+    if cfg.output.shared_emptyroom:
+        when = _read_meas_date(_raw_path(cfg.dirs.emptyroom_dir, cfg.session.ids, cfg.session.emptyroom_prefix)) \
+            or _prefix_time(cfg.session.emptyroom_prefix).astimezone(datetime.timezone.utc)
+        return {"subject": "emptyroom", "session": f"{when:%Y%m%d}", "task": "noise", "acquisition": f"{when:%H%M%S}"}
+    return {"subject": f"{cfg.session.ids:03}", "session": cfg.session.session, "task": "noise", "acquisition": None}
+
+
+
+
+def _source_paths(cfg):
+    """Files that bids_conversion reads for each output of cfg (same keys as _output_paths)."""
+
+    subj = cfg.session.ids
+    sources = dict()
+    if cfg.session.emptyroom_prefix:
+        sources["emptyroom"] = [_raw_path(cfg.dirs.emptyroom_dir, subj, cfg.session.emptyroom_prefix)]
+    if cfg.output.separate_runs:
+        for rr, run in enumerate(cfg.session.run_prefix):
+            sources[f"run-{rr + 1:02}"] = [_raw_path(cfg.dirs.data_dir, subj, run)]
+    else:
+        sources["task"] = [_raw_path(cfg.dirs.data_dir, subj, run) for run in cfg.session.run_prefix]
+    if cfg.dirs.anat_path:
+        sources["anat"] = [cfg.dirs.anat_path]
+    return sources
+
+
+
+
+_EMPTYROOM_OUTPUT = ("buffer_size_sec", "split_size", "precision", "passthrough")  # the rest only affect the runs
+
+
+def _cfg_hash(cfg, key):
+    """
+    Hash of the resolved cfg entries that affect output `key`. The task and run outputs depend on everything except
+    the anatomical image (and a separately written run not on the other runs), the empty room only on its own
+    recording and on the output settings that change how a recording is written (_EMPTYROOM_OUTPUT), and the anat
+    output only on where it is written.
+    """
+
+    if key == "anat":
+        relevant = {"ids": cfg.session.ids, "session": cfg.session.session,
+                    "bids_dir": cfg.dirs.bids_dir}
+    elif key == "emptyroom":
+        # not on the runs, task, trigger or task-only output settings (e.g. output.separate_runs), so that adding a
+        # run does not rewrite the empty room, and a shared one does not flip between subjects' settings
+        relevant = {"recording_info": cfg.to_dict()["recording_info"], "qc": cfg.to_dict()["qc"],
+                    "output": {name: getattr(cfg.output, name) for name in _EMPTYROOM_OUTPUT}}
+        if cfg.output.shared_emptyroom:
+            # shared by every subject that recorded on that day, so it must not depend on their directories
+            relevant["bids_dir"] = cfg.dirs.bids_dir
+        else:
+            relevant.update(emptyroom_dir=cfg.dirs.emptyroom_dir, ids=cfg.session.ids, session=cfg.session.session,
+                            emptyroom_prefix=cfg.session.emptyroom_prefix)
+    else:
+        relevant = cfg.to_dict()
+        del relevant["input"]  # read-ahead settings do not change the output
+        relevant["dirs"] = {name: path for name, path in relevant["dirs"].items() if name != "anat_path"}
+    if key != "anat":
+        relevant["channels"] = {"keep": cfg.input.keep_channels, "drop": cfg.input.drop_channels}
+    if key.startswith("run-"):
+        # a separately written run only depends on its own prefix and trigger settings
+        rr = int(key[len("run-"):]) - 1
+        relevant["session"]["run_prefix"] = relevant["session"]["run_prefix"][rr:rr + 1]
+        for name in ("stim_id", "old_trigger_id", "new_trigger_id"):
+            relevant["trigger"][name] = relevant["trigger"][name][rr:rr + 1]
+    if "trigger" in relevant:
+        # event_desc maps trigger codes as well as descriptions, which json cannot sort together
+        relevant["trigger"]["event_desc"] = {repr(code): desc
+                                             for code, desc in relevant["trigger"]["event_desc"].items()}
+
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+
+
+def _fingerprint(fn, previous=None, rehash=True):
+    """
+    Size, mtime and SHA-256 of a source file. The content hash is only recomputed when the size or mtime differ
+    from the `previous` fingerprint, so checking an unchanged archive costs one stat() per file. With rehash=False
+    the hash of a changed file is left as None instead of being recomputed.
+    """
+
+    stat = os.stat(fn)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and all(previous.get(field) == value for field, value in fingerprint.items()):
+        fingerprint["sha256"] = previous["sha256"]
+        return fingerprint
+    if not rehash:
+        fingerprint["sha256"] = None
+        return fingerprint
+
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as stream:
+        for block in iter(lambda: stream.read(1 << 23), b""):
+            digest.update(block)
+    fingerprint["sha256"] = digest.hexdigest()
+    return fingerprint
+
+
+
+
+def _manifest_path(cfg):
+    """
+    Location of the conversion manifest of cfg's subject, session and task in the BIDS derivatives. Each task has
+    its own manifest, since configs of different tasks of one session would otherwise overwrite each other's entries.
+    """
+
+    return os.path.join(cfg.dirs.bids_dir, "derivatives", "opm_format_bids",
+                        f"sub-{cfg.session.ids:03}_ses-{cfg.session.session}_task-{cfg.session.task}_manifest.json")
+
+
+
+
+def _load_manifest(cfg):
+    """
+    Loads cfg's manifest. A session converted before manifests were kept per task falls back to the entries of its
+    per-session manifest that are outputs of cfg.
+    """
+
+    fn = _manifest_path(cfg)
+    if os.path.exists(fn):
+        with open(fn, 'r') as stream:
+            return json.load(stream)
+
+    legacy_fn = os.path.join(os.path.dirname(fn), f"sub-{cfg.session.ids:03}_ses-{cfg.session.session}_manifest.json")
+    if not os.path.exists(legacy_fn):
+        return {"outputs": {}}
+    with open(legacy_fn, 'r') as stream:
+        legacy = json.load(stream)
+    outputs = set(_output_paths(cfg).values())
+    return {"outputs": {key: entry for key, entry in legacy.get("outputs", {}).items() if entry.get("output") in outputs}}
+
+
+
+
+def _save_manifest(cfg, manifest):
+    """Writes the manifest via a temporary file, so an interrupted run never leaves it half-written."""
+
+    fn = _manifest_path(cfg)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn + ".tmp", 'w') as stream:
+        json.dump(manifest, stream, indent=2, sort_keys=True)
+    os.replace(fn + ".tmp", fn)
+
+
+
+
+def _emptyroom_store_path(cfg):
+    """
+    Location of the shared empty room store, which maps the content hash of every empty room recording converted
+    with cfg.output.shared_emptyroom to its output, so that each one is converted once for all subjects.
+    """
+
+    return os.path.join(cfg.dirs.bids_dir, "derivatives", "opm_format_bids", "emptyroom_store.json")
+
+
+
+
+def _load_emptyroom_store(cfg):
+
+    fn = _emptyroom_store_path(cfg)
+    if not os.path.exists(fn):
+        return dict()
+    with open(fn, 'r') as stream:
+        return json.load(stream)
+
+
+
+
+def _update_emptyroom_store(cfg, sha256, entry):
+    """Adds one converted empty room to the store (read-modify-write under the BIDS root lock)."""
+
+    fn = _emptyroom_store_path(cfg)
+    with _bids_root_lock(cfg.dirs.bids_dir):
+        store = _load_emptyroom_store(cfg)
+        store[sha256] = entry
+        with open(fn + ".tmp", 'w') as stream:
+            json.dump(store, stream, indent=2, sort_keys=True)
+        os.replace(fn + ".tmp", fn)
+
+
+
+
+def _stored_emptyroom(cfg, entry, store=None):
+    """
+    Whether the empty room described by the manifest `entry` (see conversion_plan) has already been converted into
+    the shared store with the same output path and settings.
+    """
+
+    store = _load_emptyroom_store(cfg) if store is None else store
+    (fingerprint,) = entry["inputs"].values()
+    stored = store.get(fingerprint["sha256"] or "", {})
+    return stored.get("output") == entry["output"] and stored.get("cfg_sha256") == entry["cfg_sha256"] \
+        and _output_exists(entry["output"])
+
+
+
+
+def _output_exists(fn):
+    """Whether a BIDS output exists; large FIF outputs are found through their `_split-01` file."""
+
+    return os.path.exists(fn) or (fn.endswith("_meg.fif") and os.path.exists(fn.replace("_meg.fif", "_split-01_meg.fif")))
+
+
+
+
+def conversion_plan(cfg, manifest=None, force=False, rehash=True):
+    """
+    Compares the current inputs of every output of cfg against the manifest written by earlier conversions.
+    An output is stale if it is missing, if the cfg entries it depends on changed, or if the content hash of any
+    of its source files changed (a touched but otherwise identical file does not count). A shared empty room
+    (cfg.output.shared_emptyroom) is not stale if the store shows that it was converted for another subject.
+    Parameters:
+        cfg (BidsConfig): The configuration (see bids_conversion).
+        manifest (dict): A loaded manifest; read from the BIDS derivatives if None.
+        force (bool): Mark every output as stale regardless of the manifest.
+        rehash (bool): Hash source files whose size or mtime changed. If False, such files make their outputs
+            stale without being read (for a quick dry run).
+    Returns:
+        tuple: (stale, entries), where stale lists the output keys that must be (re)written, in write order, and
+            entries maps every output key to its current manifest entry (input fingerprints and cfg hash).
+    """
+
+    if manifest is None:
+        manifest = _load_manifest(cfg)
+
+    outputs = _output_paths(cfg)
+    sources = _source_paths(cfg)
+    store = _load_emptyroom_store(cfg) if cfg.output.shared_emptyroom else {}
+    stored_fingerprints = {stored["source"]: stored["fingerprint"] for stored in store.values()}
+    stale, entries = list(), dict()
+    for key, out_fn in outputs.items():
+        previous = manifest["outputs"].get(key, {})
+        entries[key] = {
+            "output": out_fn,
+            "cfg_sha256": _cfg_hash(cfg, key),
+            "inputs": {fn: _fingerprint(fn, previous.get("inputs", {}).get(fn) or stored_fingerprints.get(fn), rehash)
+                       for fn in sources[key]},
+        }
+        if key == "emptyroom" and store and not force and _stored_emptyroom(cfg, entries[key], store):
+            continue  # converted for another subject
+        unchanged = (
+            previous.get("output") == out_fn
+            and previous.get("cfg_sha256") == entries[key]["cfg_sha256"]
+            and {fn: fp["sha256"] for fn, fp in previous.get("inputs", {}).items()}
+                == {fn: fp["sha256"] for fn, fp in entries[key]["inputs"].items()}
+        )
+        if force or not unchanged or not _output_exists(out_fn):
+            stale.append(key)
+
+    return stale, entries
+
+
+
+
+def plan_outputs(cfg, force=False, headers=False):
+    """
+    Lists every file that bids_conversion(cfg) would create or update, without reading any data. The paths follow
+    the BIDS names that mne_bids gives the outputs of _output_paths (including split parts and sidecars), and the
+    sizes of the recordings are estimated from their source files (a FIF file copied to FIF keeps its size) and
+    from cfg.output.split_size. With headers=True, the headers of the recordings are also read and checked by
+    preflight, which gives exact sample counts, durations and events (this imports mne).
+    Parameters:
+        cfg (BidsConfig): The configuration (see bids_conversion).
+        force (bool): Plan as for bids_conversion(force=True).
+        headers (bool): Read the recording headers. Defaults to False.
+    Returns:
+        list of dict: One entry per file, with keys "path", "output" (the output it belongs to, or "dataset" for
+            files shared by the BIDS root), "write" (False if the output is up to date), "bytes" (estimated, None
+            for small text sidecars) and "duration" (s, recordings only; None without headers).
+    Raises:
+        ValueError: If headers=True and preflight fails.
+    """
+
+    stale, entries = conversion_plan(cfg, force=force, rehash=False)
+    outputs = _output_paths(cfg)
+    sources = _source_paths(cfg)
+    split_size = _parse_size(cfg.output.split_size)
+    subj, session = f"sub-{cfg.session.ids:03}", f"ses-{cfg.session.session}"
+
+    meg_keys = [key for key in outputs if key != "anat"]
+    report = preflight(cfg) if headers else None
+    recordings = dict()
+    if report:
+        recordings["emptyroom"] = [report["emptyroom"]] if report["emptyroom"] else []
+        if cfg.output.separate_runs:
+            recordings.update({f"run-{rr + 1:02}": [header] for rr, header in enumerate(report["runs"])})
+        else:
+            recordings["task"] = report["runs"]
+
+    plan = list()
+
+    def _add(path, output, n_bytes=None, duration=None):
+        plan.append({"path": path, "output": output, "write": output == "dataset" or output in stale,
+                     "bytes": n_bytes, "duration": duration})
+
+    for key in meg_keys:
+        fn = outputs[key]
+        if report:
+            n_bytes, n_splits = report["output_bytes"][key], report["n_splits"][key]
+            duration = sum(h["n_times"] / h["info"]["sfreq"] for h in recordings[key])
+        else:
+            n_bytes = sum(os.path.getsize(source) for source in sources[key])
+            n_splits, duration = max(1, -(-n_bytes // (split_size - 2**20))), None
+        if n_splits == 1:
+            _add(fn, key, n_bytes, duration)
+        else:
+            for split in range(n_splits):
+                split_bytes = min(split_size - 2**20, n_bytes - split * (split_size - 2**20))
+                _add(fn.replace("_meg.fif", f"_split-{split + 1:02}_meg.fif"), key, split_bytes,
+                     None if duration is None else duration * split_bytes / n_bytes)
+        for sidecar in ("_meg.json", "_channels.tsv"):
+            _add(fn.replace("_meg.fif", sidecar), key)
+        if cfg.qc.enabled:
+            for qc_fn in _qc_paths(cfg, fn):
+                _add(qc_fn, key)
+        if key != "emptyroom":
+            # without headers, assume the runs carry annotations (as Cerca recordings do)
+            annotated = any(len(h["annotations"]) for h in recordings[key]) if report else True
+            if cfg.trigger.find_events or annotated:
+                for sidecar in ("_events.tsv", "_events.json"):
+                    _add(fn.replace("_meg.fif", sidecar), key)
+
+    if "anat" in outputs:
+        _add(outputs["anat"], "anat", os.path.getsize(cfg.dirs.anat_path))  # upper bound once gzipped
+
+    # files shared with other outputs and subjects, which mne_bids updates with every MEG write (not write_anat)
+    if any(key in stale for key in meg_keys):
+        session_dir = os.path.join(cfg.dirs.bids_dir, subj, session)
+        _add(os.path.join(session_dir, "meg", f"{subj}_{session}_coordsystem.json"), "dataset")
+        _add(os.path.join(session_dir, f"{subj}_{session}_scans.tsv"), "dataset")
+        for name in ("dataset_description.json", "README", "participants.tsv", "participants.json"):
+            _add(os.path.join(cfg.dirs.bids_dir, name), "dataset")
+
+    return plan
+
+
+
+
+def bids_conversion(cfg, n_jobs=1, force=False, profile=None):
+    """
+    Converts raw MEG data files to BIDS format using configuration parameters provided in cfg.
+    This function performs the following steps:
+        1. Extracts necessary configuration parameters such as subject ID, session information, run prefixes,
+           empty room prefix, task name, and anatomical scan indicator, and compares the size, mtime and content
+           hash of every source file (plus a hash of the resolved cfg) against the manifest stored in
+           `<bids_dir>/derivatives/opm_format_bids`. Outputs whose inputs are unchanged are skipped. The headers of
+           the recordings to be converted are then checked against each other by preflight, which aborts the
+           conversion before any data are read if the runs cannot be concatenated.
+        2. Reads and processes the empty room file if specified in cfg.session.emptyroom_prefix. The
+           empty room raw data is read, its line frequency updated based on cfg.recording_info.line_freq,
+           and then written to a BIDS-compatible directory structure.
+        3. Iterates over each run specified in cfg.session.run_prefix:
+            - Constructs the file path for the raw MEG data.
+            - Reads the raw data and updates its metadata (line frequency and subject information).
+            - Optionally finds and merges events if cfg.trigger.find_events is True, setting the resulting
+              annotations on the raw data. Only the stim channels are read for this, in one blockwise pass, and
+              their triggers are decoded and remapped together by decode_triggers.
+            - Appends the processed raw data for later concatenation.
+        4. Concatenates the individual raw run data into a single raw object (without preloading it) and prints
+           the recording duration.
+        5. Optionally renames annotation descriptions if cfg.trigger.rename_annot is True.
+        6. Associates the empty room information with the concatenated raw object if applicable.
+        7. Once the empty room has been written, writes the concatenated raw data to the BIDS directory, streaming
+           it from the source files in blocks of cfg.output.buffer_size_sec seconds and splitting at
+           cfg.output.split_size. The empty room write itself runs on a background thread while the runs
+           are loaded.
+        8. If an anatomical scan is provided (cfg.dirs.anat_path is not None), writes the anatomical image
+           to the BIDS structure (concurrently with the MEG writes). Errors from the background writes are
+           re-raised once all writes have finished.
+        With cfg.output.separate_runs, steps 3-7 are instead done for each run on its own (see _write_run): every
+        run is read, annotated and written as output `run-NN`, associated with the empty room, with the runs
+        spread over `n_jobs` worker processes. Only the runs whose source or trigger settings changed are
+        rewritten.
+        Each output is written to a staging root under `<bids_dir>/derivatives/opm_format_bids/staging` and moved
+        into bids_dir only once complete (see _commit_staged), after which it is recorded in the manifest. The
+        manifest thus doubles as a journal: if the conversion is killed, no partial files are left in bids_dir,
+        and rerunning it skips the outputs that were committed and resumes at the first one that was not.
+    Parameters:
+        cfg (BidsConfig): The validated configuration returned by set_bids_params, with the sections:
+                - "session": with fields:
+                    - "ids": Subject identifier.
+                    - "run_prefix": List of run prefixes.
+                    - "emptyroom_prefix": Prefix for empty room data (evaluated as False if not provided; "auto" is
+                      resolved by set_bids_params to the recording closest in time, see select_emptyroom).
+                    - "task": Task name.
+                    - "session": Session label.
+                - "dirs": with fields:
+                    - "data_dir": Base directory for raw MEG data.
+                    - "emptyroom_dir": Directory containing empty room files.
+                    - "anat_path": Path to anatomical scans (evaluated as False if not provided).
+                    - "bids_dir": Output directory for BIDS formatted data.
+                - "recording_info": with field:
+                    - "line_freq": The line frequency value to be set in the raw data info.
+                - "trigger": with fields:
+                    - "find_events": Boolean flag to determine if events should be located.
+                    - "stim_id": List of stimulus channel identifiers per run.
+                    - "old_trigger_id": List of trigger IDs to be replaced.
+                    - "new_trigger_id": List of new trigger IDs to use.
+                    - "event_desc": Dictionary mapping event codes to descriptions.
+                    - "rename_annot": Boolean flag to determine if annotations should be renamed, by the description
+                      keys of event_desc (for decoded events, folded into their code table, see annotations_from_codes).
+                - "output": with fields:
+                    - "buffer_size_sec": Length (s) of the blocks read and written when streaming to BIDS.
+                    - "split_size": Maximum size of each FIF file before it is split (e.g. "2GB").
+                    - "separate_runs": Write each run as its own output (run-01 to run-NN) instead of
+                      concatenating them into run-01.
+                    - "passthrough": Copy the data buffers of the source files verbatim when no sample changes
+                      (no channel selection, projection, cropping or change of format), see _passthrough_fif.
+                    - "precision": Sample format of the MEG outputs ("single", "double" or "short", with each
+                      channel calibrated to its peak); null keeps the format of the source files.
+                - "input": with fields:
+                    - "prefetch_depth": Number of runs read ahead of the one being loaded when n_jobs is 1 and
+                      trigger.find_events is set, i.e. when loading reads the stim samples (0 disables read-ahead;
+                      see RunPrefetcher). Without event finding, loading only reads headers and nothing is read ahead.
+                    - "prefetch_mb": Budget (MB) for the bytes read ahead and not yet loaded.
+                    - "keep_channels" / "drop_channels": Channel names, globs or types to keep (null: all) and to
+                      drop; applied to the runs (after event finding) and the empty room before they are written.
+                - "qc": with fields:
+                    - "enabled": Save per-channel QC statistics of the MEG outputs, computed from the blocks
+                      streamed by the write (see ChannelQC), to `<bids_dir>/derivatives/opm_format_bids/qc`.
+                      Off by default: it decodes every sample, which also rules out the verbatim copy of
+                      output.passthrough.
+                    - "psd_window_sec", "flat_window_sec", "flat_ptp": Welch window, flat window and flat threshold.
+        n_jobs (int): Number of worker processes used to load the empty room file and the runs (including event
+            finding) in parallel. Results are gathered in run order before concatenation. Defaults to 1 (serial).
+        force (bool): Rewrite every output, even those the manifest shows to be up to date. Defaults to False.
+        profile (ConversionProfile): If given, receives the wall time, CPU time, peak RSS and bytes read/written
+            of every stage (empty room read/write, per-run read, event finding, concatenation, rename, BIDS
+            write and anat write), including those run in pool workers.
+    Returns:
+        list of str: The outputs that were written ("emptyroom", "task" or "run-NN", and/or "anat"); empty if all were
+            up to date. The manifest is updated after each one.
+    Raises:
+        ValueError: If preflight finds recordings that cannot be converted together.
+        Any exceptions raised from file I/O operations, MNE functions, or issues during raw concatenation are
+        propagated to the caller.
+    Note:
+        mne and mne_bids are imported on the first call, not when this module is imported.
+    """
+
+    import mne
+    import mne_bids
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+    # %% convert to BIDS ---------------------------------------------------------
+
+    subj = cfg.session.ids
+    runs = cfg.session.run_prefix
+    emptyroom = cfg.session.emptyroom_prefix
+    task = cfg.session.task
+    anat_path = cfg.dirs.anat_path
+
+    print("\nparticipant: ", subj,
+          "\nruns: ", runs,
+          "\nemptyroom: ", emptyroom,
+          "\ntask: ", task,
+          "\nanat path: ", anat_path,
+          "\n--------\n")
+
+    # Skip outputs whose inputs are unchanged since the last conversion --------
+    manifest = _load_manifest(cfg)
+    stale, entries = conversion_plan(cfg, manifest, force=force)
+    current = {entry["output"] for entry in entries.values()}
+    for key in set(manifest["outputs"]) - set(entries):
+        # e.g. the runs of a session that was converted before output.separate_runs was changed
+        if manifest["outputs"][key]["output"] not in current:
+            print(f"WARNING: {manifest['outputs'][key]['output']} is no longer an output of this config "
+                  "(remove it if it is obsolete)")
+        del manifest["outputs"][key]
+    for key in entries:
+        if key not in stale:
+            print(f"{key} output is up to date, skipping: {entries[key]['output']}")
+            manifest["outputs"][key] = entries[key]  # refresh mtimes for the next stat-only check
+    if not stale:
+        _save_manifest(cfg, manifest)
+        return stale
+
+    # The manifest is the journal of the conversion: outputs about to be rewritten are dropped from it now and
+    # recorded again only once committed, so that a conversion killed at any point resumes at the first output
+    # that was not committed.
+    for key in stale:
+        manifest["outputs"].pop(key, None)
+    _save_manifest(cfg, manifest)
+
+    commit_lock = threading.Lock()
+
+    def _commit(key):
+        with commit_lock:
+            manifest["outputs"][key] = entries[key]
+            _save_manifest(cfg, manifest)
+
+    profile = profile if profile is not None else ConversionProfile()
+    load_emptyroom = "emptyroom" in stale
+    run_keys = [key for key in stale if key.startswith("run-")]
+    load_runs = "task" in stale or bool(run_keys)
+    concatenate = "task" in stale
+    # loading a run only reads its samples when its events are decoded; otherwise it only parses the header, and
+    # reading the whole file ahead would read it once more than the write does
+    prefetch_depth = cfg.input.prefetch_depth if cfg.trigger.find_events else 0
+
+    # Check the headers of everything that will be loaded before reading any data
+    if load_emptyroom or load_runs:
+        print("\npreflight --------\n")
+        with profile.stage("preflight"):
+            report = preflight(cfg, runs=load_runs, emptyroom=load_emptyroom, n_jobs=n_jobs)
+        _print_preflight(report)
+
+    # Every output is written to its own staging root and then committed into bids_dir (see _commit_staged), so
+    # that an interrupted write never leaves partial files in the BIDS root.
+    def _emptyroom_bids_path(root):
+        return mne_bids.BIDSPath(
+            **_emptyroom_entities(cfg),
+            datatype="meg",
+            root=root,
+        ) if emptyroom else None
+
+    def _write_emptyroom(raw_empty_room):
+        entry = entries["emptyroom"]
+        qc_output = entry["output"] if cfg.qc.enabled else None
+        if not cfg.output.shared_emptyroom:
+            staging_root = _staging_root(cfg, "emptyroom")
+            with profile.stage("emptyroom_write"):
+                _write_meg_bids(raw_empty_room, _emptyroom_bids_path(staging_root), cfg, qc_output=qc_output)
+                _commit_staged(staging_root, cfg.dirs.bids_dir, entry["output"])
+            _commit("emptyroom")
+            return
+
+        # Shared empty room: one writer per recording; the others wait for it and then find it in the store
+        ((source, fingerprint),) = entry["inputs"].items()
+        lock_fn = os.path.join(os.path.dirname(_emptyroom_store_path(cfg)), f"emptyroom-{fingerprint['sha256'][:16]}.lock")
+        with _file_lock(lock_fn):
+            if not force and _stored_emptyroom(cfg, entry):
+                print(f"empty room already converted for another subject: {entry['output']}")
+            else:
+                staging_root = _staging_root(cfg, f"emptyroom-{fingerprint['sha256'][:16]}")
+                with profile.stage("emptyroom_write"):
+                    _write_meg_bids(raw_empty_room, _emptyroom_bids_path(staging_root), cfg, qc_output=qc_output)
+                    _commit_staged(staging_root, cfg.dirs.bids_dir, entry["output"])
+                _update_emptyroom_store(cfg, fingerprint["sha256"], {
+                    "output": entry["output"], "cfg_sha256": entry["cfg_sha256"],
+                    "source": source, "fingerprint": fingerprint})
+        _commit("emptyroom")
+
+    def _write_anat():
+        staging_root = _staging_root(cfg, "anat")
+        anat_bids_path = mne_bids.BIDSPath(
+            subject=f"{subj:03}",
+            session=cfg.session.session,
+            suffix="T1w",
+            root=staging_root,
+        )
+
+        with profile.stage("anat_write"):
+            mne_bids.write_anat(
+                image=anat_path, 
+                bids_path=anat_bids_path, 
+                overwrite=True
+                )
+            _commit_staged(staging_root, cfg.dirs.bids_dir, entries["anat"]["output"])
+
+        _commit("anat")
+        print('saved to anat path: ', anat_path)
+
+    # The anat and empty room writes run on writer threads, overlapping with the loading of the runs and with
+    # each other. The task write waits for the empty room, which its sidecar points to.
+    with ThreadPoolExecutor(max_workers=2) as writers:
+        anat_future = writers.submit(_write_anat) if "anat" in stale else None
+        er_future = None
+
+        # Load empty room and runs -------------------------------------------
+        if n_jobs > 1 and concatenate:
+            print(f"\nloading {len(runs)} runs with {n_jobs} workers --------\n")
+            # forkserver: the anat writer thread is already running, and forking a multi-threaded process can
+            # deadlock the workers
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("forkserver")) as pool:
+                er_load = pool.submit(_profiled, _load_emptyroom, cfg) if load_emptyroom else None
+                run_loads = pool.map(_profiled, repeat(_load_run), repeat(cfg), range(len(runs)), runs)
+                if er_load:
+                    raw_empty_room, records = er_load.result()
+                    profile.extend(records)
+                    er_future = writers.submit(_write_emptyroom, raw_empty_room)
+                loaded = list(run_loads)
+            raw_list = [raw for raw, _ in loaded]
+            for _, records in loaded:
+                profile.extend(records)
+        else:
+            if load_emptyroom:
+                er_future = writers.submit(_write_emptyroom, _load_emptyroom(cfg, profile=profile))
+            raw_list = list()
+            if concatenate:
+                # read the next runs from disk while the current one is decoded
+                fns = [_raw_path(cfg.dirs.data_dir, subj, run) for run in runs]
+                with RunPrefetcher(fns, depth=prefetch_depth, budget_mb=cfg.input.prefetch_mb,
+                                   profile=profile, runs=runs) as prefetcher:
+                    for rr, _ in enumerate(prefetcher):
+                        raw_list.append(_load_run(cfg, rr, runs[rr], profile=profile))
+
+
+        if concatenate:
+
+            # Concatenate raws for all runs of this subject (without loading the data)
+            with profile.stage("concatenate"):
+                all_raw = mne.concatenate_raws(raw_list, preload=False, on_mismatch="raise")
+
+            recording_duration = all_raw.times[-1] - all_raw.times[0]
+            print(f"Recording duration for subject {subj}: {recording_duration:.2f} seconds")
+
+            # Rename annotations
+            if cfg.trigger.rename_annot and not cfg.trigger.find_events:  # decoded events are named when loaded
+                with profile.stage("rename"):
+                    rename_annotations(all_raw.annotations, cfg.trigger.event_desc)
+            
+            # Write to BIDS ---------------------------------------------------
+            staging_root = _staging_root(cfg, "task")
+            bids_path = mne_bids.BIDSPath(
+                subject=f"{subj:03}",
+                session=cfg.session.session,
+                task=task,
+                run="01",
+                root=staging_root,
+            )
+
+            if er_future:
+                er_future.result()
+            with profile.stage("bids_write"):
+                # mne_bids needs the associated empty room under the same root
+                if emptyroom:
+                    _link_staged(_output_paths(cfg)["emptyroom"], cfg.dirs.bids_dir, staging_root)
+                _write_meg_bids(all_raw, bids_path, cfg, empty_room=_emptyroom_bids_path(staging_root),
+                                qc_output=entries["task"]["output"] if cfg.qc.enabled else None)
+                _commit_staged(staging_root, cfg.dirs.bids_dir, entries["task"]["output"])
+            _commit("task")
+
+        # Or write each run as its own output, on its own worker ------------
+        if run_keys:
+            if er_future:
+                er_future.result()
+            rrs = [int(key[len("run-"):]) - 1 for key in run_keys]
+            if n_jobs > 1 and len(rrs) > 1:
+                print(f"\nwriting {len(rrs)} runs with {n_jobs} workers --------\n")
+                with ProcessPoolExecutor(max_workers=n_jobs,
+                                         mp_context=multiprocessing.get_context("forkserver")) as pool:
+                    futures = [pool.submit(_profiled, _write_run, cfg, rr) for rr in rrs]
+                    for future in as_completed(futures):
+                        key, records = future.result()
+                        profile.extend(records)
+                        _commit(key)
+            else:
+                fns = [_raw_path(cfg.dirs.data_dir, subj, runs[rr]) for rr in rrs]
+                with RunPrefetcher(fns, depth=prefetch_depth, budget_mb=cfg.input.prefetch_mb,
+                                   profile=profile, runs=[runs[rr] for rr in rrs]) as prefetcher:
+                    for rr, _ in zip(rrs, prefetcher):
+                        _commit(_write_run(cfg, rr, profile=profile))
+
+        # re-raise any error from the writer threads
+        for future in (er_future, anat_future):
+            if future:
+                future.result()
+
+    return stale
+
+
+
+# %% batch conversion ---------------------------------------------------------
+
+def find_configs(batch_path):
+    """
+    Lists the subject configs to convert in batch mode.
+    Parameters:
+        batch_path (str): Either a directory, which is searched recursively for `config-bids_sub-*.yml` files,
+            or a manifest text file with one config path per line (relative paths are resolved against the
+            manifest's directory; blank lines and `#` comments are ignored).
+    Returns:
+        list of str: Config paths, in sorted (directory) or listed (manifest) order.
+    """
+
+    if os.path.isdir(batch_path):
+        return sorted(glob.glob(os.path.join(batch_path, "**", "config-bids_sub-*.yml"), recursive=True))
+
+    config_paths = list()
+    with open(batch_path, 'r') as stream:
+        for line in stream:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                config_paths.append(os.path.join(os.path.dirname(os.path.abspath(batch_path)), line))
+    return config_paths
+
+
+
+
+def _convert_config(config_path, n_jobs=1, force=False):
+    """
+    Converts one subject config in batch mode. Errors are caught and reported rather than raised, so that
+    one broken subject does not stop the rest of the batch.
+    Returns:
+        tuple: (config_path, subject, status, elapsed seconds, error message, stage records), where status is
+            one of "converted", "skipped" or "failed".
+    """
+
+    start = time.perf_counter()
+    subj = ""
+    profile = ConversionProfile(config=config_path)
+    try:
+        cfg = set_bids_params(config_path)
+        subj = f"{cfg.session.ids:03}"
+        profile.details["subject"] = subj
+        written = bids_conversion(cfg, n_jobs=n_jobs, force=force, profile=profile)
+    except Exception as err:
+        return config_path, subj, "failed", time.perf_counter() - start, f"{type(err).__name__}: {err}", profile.records
+
+    status = "converted" if written else "skipped"
+    return config_path, subj, status, time.perf_counter() - start, "", profile.records
+
+
+
+
+def run_batch(batch_path, n_workers=1, n_jobs=1, force=False):
+    """
+    Converts every subject config listed by find_configs(batch_path) (or given as a list of config paths, e.g.
+    from opm_catalog.pending_configs), scheduling subjects over a pool of
+    `n_workers` processes (each of which loads its runs with `n_jobs` workers). Subjects whose outputs are up to
+    date according to their conversion manifest are skipped unless `force` is True. Prints a summary table and returns the per-subject results.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    if isinstance(batch_path, str):
+        config_paths = find_configs(batch_path)
+        print(f"\nbatch: {len(config_paths)} configs from {batch_path}\n")
+    else:
+        config_paths = list(batch_path)
+        print(f"\nbatch: {len(config_paths)} configs\n")
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_convert_config, fn, n_jobs, force) for fn in config_paths]
+            results = [future.result() for future in as_completed(futures)]
+        results.sort(key=lambda result: config_paths.index(result[0]))
+    else:
+        results = [_convert_config(fn, n_jobs, force) for fn in config_paths]
+
+    print("\n\nbatch summary ---------------------------------------------------------\n")
+    print(f"{'subject':<10}{'status':<12}{'time (s)':>10}  config")
+    for config_path, subj, status, elapsed, error, _ in results:
+        print(f"{subj:<10}{status:<12}{elapsed:>10.1f}  {config_path}")
+        if error:
+            print(f"{'':<10}{error}")
+    counts = {status: sum(result[2] == status for result in results) for status in ("converted", "skipped", "failed")}
+    print("\n" + ", ".join(f"{n} {status}" for status, n in counts.items()))
+
+    return results
+
+
+    
+# %% command line ---------------------------------------------------------------
+
+def _config_paths(paths):
+    """Expands config arguments: directories and manifest (non-YAML) files are resolved with find_configs."""
+
+    config_paths = list()
+    for path in paths:
+        if os.path.isdir(path) or not path.endswith((".yml", ".yaml")):
+            config_paths.extend(find_configs(path))
+        else:
+            config_paths.append(path)
+    return config_paths
+
+
+
+
+def _cmd_convert(args):
+    profile = ConversionProfile()
+    print('config path: ', args.config_path)
+    cfg = set_bids_params(args.config_path)
+    bids_conversion(cfg, n_jobs=args.jobs, force=args.force, profile=profile)
+    profile.print_summary()
+    return profile, 0
+
+
+
+
+def _cmd_batch(args):
+    profile = ConversionProfile()
+    if args.catalog:
+        import opm_catalog
+        batch_path = opm_catalog.pending_configs(args.catalog, task=args.task)
+    elif args.batch_path:
+        batch_path = args.batch_path
+    else:
+        raise SystemExit("batch: give a config directory or manifest file, or --catalog")
+    results = run_batch(batch_path, n_workers=args.workers, n_jobs=args.jobs, force=args.force)
+    for result in results:
+        profile.extend(result[5])
+    return profile, int(any(result[2] == "failed" for result in results))
+
+
+
+
+def _cmd_validate(args):
+    import yaml
+
+    failed = 0
+    for config_path in _config_paths(args.config_paths):
+        try:
+            cfg = set_bids_params(config_path, check_files=not args.no_files, save_catalog=False)
+            if args.headers:
+                _print_preflight(preflight(cfg))
+        except (OSError, ValueError, yaml.YAMLError) as err:
+            print(f"INVALID {config_path}\n{err}\n")
+            failed += 1
+        else:
+            print(f"OK {config_path}\n")
+    return None, int(bool(failed))
+
+
+
+
+def _cmd_plan(args):
+    manifest = dict()
+    for config_path in _config_paths(args.config_paths):
+        cfg = set_bids_params(config_path, save_catalog=False)
+        plan = plan_outputs(cfg, force=args.force, headers=args.headers)
+        manifest[config_path] = plan
+
+        print(f"{'':<7}{'output':<11}{'size (MB)':>10}{'duration (s)':>14}  path (under {cfg.dirs.bids_dir})")
+        for entry in plan:
+            n_bytes, duration = entry["bytes"], entry["duration"]
+            print(f"{'write' if entry['write'] else 'skip':<7}{entry['output']:<11}"
+                  f"{'' if n_bytes is None else f'{n_bytes / 1e6:.1f}':>10}"
+                  f"{'' if duration is None else f'{duration:.1f}':>14}  {os.path.relpath(entry['path'], cfg.dirs.bids_dir)}")
+        to_write = [entry for entry in plan if entry["write"]]
+        print(f"\n{len(to_write)} files to write, ~{sum(entry['bytes'] or 0 for entry in to_write) / 1e6:.1f} MB\n")
+
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump(manifest, stream, indent=2)
+    return None, 0
+
+
+
+
+def main(argv=None):
+    """
+    Command line entry point, with the subcommands:
+        convert   Convert one subject config to BIDS (also used when no subcommand is given).
+        batch     Convert every subject config under a directory or listed in a manifest file.
+        validate  Check configs (and optionally the recording headers) without converting.
+        plan      List every file a conversion would write, with estimated sizes, without reading any data.
+    mne and mne_bids are only imported by convert, batch and validate --headers.
+    """
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    commands = ("convert", "batch", "validate", "plan")
+    if not argv or (argv[0] not in commands and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "convert")  # `opm_format_bids.py [CONFIG]` as before
+
+    parser = argparse.ArgumentParser(description="Convert Cerca OPM data to BIDS format.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def _conversion_args(subparser):
+        subparser.add_argument("-j", "--jobs", type=int, default=1,
+                               help="number of worker processes used to load runs (default: 1)")
+        subparser.add_argument("--force", action="store_true",
+                               help="rewrite outputs even if the conversion manifest shows them to be up to date")
+        subparser.add_argument("--profile-log", metavar="PATH",
+                               help="append per-stage timing, memory and I/O measurements to a JSON-lines file")
+        subparser.add_argument("--trace", metavar="PATH",
+                               help="write the per-stage measurements as a Chrome trace (chrome://tracing, Perfetto)")
+
+    convert = subparsers.add_parser("convert", help="convert one subject config")
+    convert.add_argument("config_path", nargs="?", default="",
+                         help="subject YAML config (defaults to the embedded base config)")
+    _conversion_args(convert)
+    convert.set_defaults(func=_cmd_convert)
+
+    batch = subparsers.add_parser("batch", help="convert many subject configs")
+    batch.add_argument("batch_path", nargs="?",
+                       help="directory searched for config-bids_sub-*.yml, or a manifest file")
+    batch.add_argument("--catalog", metavar="DB",
+                       help="convert the sessions that an opm_catalog.py database lists as not (fully) converted")
+    batch.add_argument("--task", help="with --catalog, only sessions of this task")
+    batch.add_argument("--workers", type=int, default=1,
+                       help="number of subjects converted at once (default: 1)")
+    _conversion_args(batch)
+    batch.set_defaults(func=_cmd_batch)
+
+    validate = subparsers.add_parser("validate", help="check configs without converting")
+    validate.add_argument("config_paths", nargs="+", metavar="PATH",
+                          help="subject YAML configs, config directories or manifest files")
+    validate.add_argument("--no-files", action="store_true",
+                          help="do not check that the input directories and recordings exist")
+    validate.add_argument("--headers", action="store_true",
+                          help="also read the recording headers and run the preflight checks (imports mne)")
+    validate.set_defaults(func=_cmd_validate)
+
+    plan = subparsers.add_parser("plan", help="list the outputs a conversion would write")
+    plan.add_argument("config_paths", nargs="+", metavar="PATH",
+                      help="subject YAML configs, config directories or manifest files")
+    plan.add_argument("--force", action="store_true", help="plan as for convert --force")
+    plan.add_argument("--headers", action="store_true",
+                      help="read the recording headers for exact sizes and durations (imports mne)")
+    plan.add_argument("--json", metavar="PATH", help="also write the planned files to a JSON file")
+    plan.set_defaults(func=_cmd_plan)
+
+    args = parser.parse_args(argv)
+    profile, status = args.func(args)
+
+    if profile is not None:
+        if args.profile_log:
+            profile.write_jsonl(args.profile_log)
+        if args.trace:
+            profile.write_chrome_trace(args.trace)
+        print("\n\n\nDONE!\n\n\n")
+
+    return status
+
+
+
+    
+# %% main ---------------------------------------------------------------------
+if __name__ == "__main__":
+    raise SystemExit(main())
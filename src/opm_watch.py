@@ -0,0 +1,297 @@
+## Watch a Cerca data share and convert sessions to BIDS as their recordings land.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import glob
+import time
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import opm_format_bids
+import opm_catalog
+
+
+
+
+# %% recordings ---------------------------------------------------------------
+
+class RecordingWatcher:
+    """
+    Polls `watch_dir` (`sub-XXX/<prefix>_cMEG_Data/<prefix>_meg.fif`) for recordings. A recording counts as
+    complete once its size and mtime are unchanged between two polls and it has not been modified for
+    `settle_sec` seconds; its header is then read once (see opm_catalog._read_recording). With `stim_channels`
+    (when the sessions' events are decoded from them, trigger.find_events), a recording without annotations also has
+    its trigger onsets counted ("n_triggers"), so that such runs can still be told apart from empty rooms.
+    """
+
+    def __init__(self, watch_dir, settle_sec=60, stim_channels=None):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.settle_sec = settle_sec
+        self.stim_channels = stim_channels
+        self.pending = dict()   # fn -> (size, mtime_ns) at the last poll
+        self.complete = dict()  # fn -> recording metadata
+
+    def poll(self):
+        """Stats every recording and returns the number that became complete in this poll."""
+
+        n_new = 0
+        now = time.time()
+        for fn in glob.glob(os.path.join(self.watch_dir, "sub-*", "*_cMEG_Data", "*_meg.fif")):
+            if fn in self.complete:
+                continue
+            try:
+                stat = os.stat(fn)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.pending.get(fn) == signature and now - stat.st_mtime > self.settle_sec:
+                prefix = os.path.basename(os.path.dirname(fn))[:-len("_cMEG_Data")]
+                try:
+                    subj = int(os.path.basename(os.path.dirname(os.path.dirname(fn)))[len("sub-"):])
+                    recording = opm_catalog._read_recording(fn, prefix)
+                    recording["n_triggers"] = _count_triggers(fn, self.stim_channels) \
+                        if self.stim_channels and not recording["n_annotations"] else 0
+                except Exception as err:
+                    print(f"cannot read {fn} yet: {err}")
+                    self.pending[fn] = signature
+                    continue
+                if not recording["n_annotations"] and not recording["n_triggers"]:
+                    print(f"{fn} has no annotations{' or triggers' if self.stim_channels else ''}: "
+                          f"taken as an empty room, not a run")
+                self.complete[fn] = {**recording, "fn": fn, "subject": subj, "prefix": prefix,
+                                     "mtime": stat.st_mtime}
+                del self.pending[fn]
+                n_new += 1
+            else:
+                self.pending[fn] = signature
+        return n_new
+
+
+
+
+def _count_triggers(fn, stim_channels):
+    """Number of trigger onsets on those of `stim_channels` that the recording has (0 if it has none of them)."""
+
+    import mne
+    import numpy as np
+
+    raw = mne.io.read_raw_fif(fn, preload=False, verbose="error")
+    present = [name for name in stim_channels if name in raw.ch_names]
+    if not present:
+        return 0
+    active = opm_format_bids._read_stim_data(raw, present, 10.0) != 0
+    return int(np.sum(active[:, 1:] & ~active[:, :-1]) + np.sum(active[:, 0]))
+
+
+
+
+def group_sessions(recordings, gap_minutes=120):
+    """
+    Groups the complete task recordings (those with annotations or, with decoded events, triggers; empty rooms have
+    neither) into sessions: per subject,
+    sorted by acquisition time, with a new session whenever two consecutive runs are more than `gap_minutes` apart.
+    Sessions are labelled with the date of their first run, with a letter appended for later sessions on that day.
+    Returns:
+        list of dict: With keys "subject", "session", "runs" (prefixes) and "last_mtime" (of the latest run file).
+    """
+
+    by_subject = dict()
+    for recording in recordings:
+        if (recording["n_annotations"] or recording.get("n_triggers")) and recording["acq_time"] \
+                and not recording["error"]:
+            by_subject.setdefault(recording["subject"], []).append(recording)
+
+    sessions = list()
+    for subj, runs in sorted(by_subject.items()):
+        runs.sort(key=lambda recording: recording["acq_time"])
+        groups = [[runs[0]]]
+        for previous, run in zip(runs, runs[1:]):
+            gap = datetime.datetime.fromisoformat(run["acq_time"]) - datetime.datetime.fromisoformat(previous["acq_time"])
+            if gap > datetime.timedelta(minutes=gap_minutes):
+                groups.append([])
+            groups[-1].append(run)
+
+        labels = dict()
+        for group in groups:
+            date = group[0]["acq_time"][:10].replace("-", "")
+            labels[date] = labels.get(date, 0) + 1
+            sessions.append({
+                "subject": subj,
+                "session": date if labels[date] == 1 else f"{date}{chr(ord('a') + labels[date] - 1)}",
+                "runs": [run["prefix"] for run in group],
+                "last_mtime": max(run["mtime"] for run in group),
+            })
+    return sessions
+
+
+
+
+def _session_signature(watch_dir, session):
+    """The runs of a session with the size and mtime of their files, which change when a run is added or rewritten."""
+
+    signature = list()
+    for prefix in session["runs"]:
+        try:
+            stat = os.stat(opm_format_bids._raw_path(watch_dir, session["subject"], prefix))
+            signature.append((prefix, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append((prefix, None, None))
+    return signature
+
+
+
+
+# %% configs ------------------------------------------------------------------
+
+def write_session_config(template, session, watch_dir, config_dir):
+    """
+    Writes the config of one session, filling in the subject, session label and runs of the template config (a
+    YAML dict in the format of config-bids_sub-XXX.yml, without the session-specific fields). The raw data and
+    empty room directories default to `watch_dir`, and the empty room to `auto` (see
+    opm_format_bids.select_emptyroom). Per-run trigger settings given for a single run are repeated for every run.
+    Returns:
+        str: Path of the config, `<config_dir>/sub-XXX/config-bids_sub-XXX_ses-<session>.yml`.
+    """
+
+    import yaml
+
+    cfg = {section: dict(values or {}) for section, values in template.items()}
+    cfg.setdefault("dirs", {}).setdefault("data_dir", watch_dir)
+    cfg["dirs"].setdefault("emptyroom_dir", watch_dir)
+    cfg["dirs"].setdefault("anat_path", None)
+    cfg.setdefault("session", {})
+    cfg["session"].update(ids=session["subject"], session=session["session"], run_prefix=session["runs"])
+    cfg["session"].setdefault("emptyroom_prefix", "auto")
+
+    for name in ("stim_id", "old_trigger_id", "new_trigger_id"):
+        table = cfg.get("trigger", {}).get(name)
+        if isinstance(table, list) and len(table) == 1:
+            cfg["trigger"][name] = table * len(session["runs"])
+
+    fn = os.path.join(config_dir, f"sub-{session['subject']:03}",
+                      f"config-bids_sub-{session['subject']:03}_ses-{session['session']}.yml")
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn + ".tmp", 'w') as stream:
+        yaml.safe_dump(cfg, stream, sort_keys=False)
+    os.replace(fn + ".tmp", fn)
+    return fn
+
+
+
+
+# %% service ------------------------------------------------------------------
+
+def watch(watch_dir, template_path, config_dir, interval=30, settle_sec=60, quiet_minutes=10, gap_minutes=120,
+          retry_minutes=60, n_workers=2, n_jobs=1, once=False):
+    """
+    Runs the ingestion service: polls `watch_dir` every `interval` seconds, groups the complete recordings into
+    sessions, and once a session has had no new run for `quiet_minutes`, writes its config and converts it on a
+    pool of `n_workers` processes. A session that receives another run after it was converted gets its config
+    rewritten and is converted again (only the outputs whose inputs changed are rewritten, see
+    opm_format_bids.conversion_plan). A session whose conversion failed is retried once its runs change (a run is
+    added or a file rewritten) or `retry_minutes` after the failure, whichever comes first. When the
+    template decodes events from stim channels (trigger.find_events), runs are recognised by their triggers rather
+    than by their annotations. With once=True, a single pass is made (treating every session as quiet)
+    and the conversions are waited for, e.g. to run from cron.
+    """
+
+    import yaml
+
+    with open(template_path, 'r') as stream:
+        template = yaml.safe_load(stream) or {}
+
+    trigger = template.get("trigger") or {}
+    stim_channels = sorted({name for run in trigger.get("stim_id") or [] for name in run}) \
+        if trigger.get("find_events") else None
+    watcher = RecordingWatcher(watch_dir, settle_sec=0 if once else settle_sec, stim_channels=stim_channels)
+    converted = dict()   # (subject, session) -> runs of the last successful conversion
+    failed = dict()      # (subject, session) -> (signature, time) of the last failed conversion
+    running = dict()     # (subject, session) -> (future, runs, signature)
+
+    def _collect(key, future, runs, signature):
+        config_path, subj, status, elapsed, error, _ = future.result()
+        print(f"{datetime.datetime.now():%H:%M:%S} sub-{key[0]:03} ses-{key[1]}: {status} in {elapsed:.1f} s {error}")
+        if status == "failed":
+            failed[key] = (signature, time.time())
+            if not once:
+                print(f"{'':<9}retrying in {retry_minutes:g} min, or once its runs change")
+        else:
+            converted[key] = runs
+            failed.pop(key, None)
+
+    print(f"\nwatching {watcher.watch_dir} every {interval} s ({n_workers} workers) --------\n")
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        try:
+            while True:
+                if once:
+                    watcher.poll()  # first sighting; the second poll confirms the file is no longer growing
+                n_new = watcher.poll()
+                if n_new:
+                    print(f"{datetime.datetime.now():%H:%M:%S} {n_new} new recordings")
+
+                # collect finished conversions
+                for key, (future, runs, signature) in list(running.items()):
+                    if future.done():
+                        _collect(key, future, runs, signature)
+                        del running[key]
+
+                # submit sessions that went quiet and changed since they were last converted
+                for session in group_sessions(watcher.complete.values(), gap_minutes=gap_minutes):
+                    key = (session["subject"], session["session"])
+                    quiet = once or time.time() - session["last_mtime"] > quiet_minutes * 60
+                    if not quiet or key in running or converted.get(key) == session["runs"]:
+                        continue
+                    signature = _session_signature(watcher.watch_dir, session)
+                    if key in failed and failed[key][0] == signature \
+                            and time.time() - failed[key][1] < retry_minutes * 60:
+                        continue  # failed on these very files; wait before retrying
+                    config_path = write_session_config(template, session, watcher.watch_dir, config_dir)
+                    print(f"{datetime.datetime.now():%H:%M:%S} converting sub-{key[0]:03} ses-{key[1]} "
+                          f"({len(session['runs'])} runs): {config_path}")
+                    running[key] = (pool.submit(opm_format_bids._convert_config, config_path, n_jobs),
+                                    session["runs"], signature)
+
+                if once:
+                    for key, (future, runs, signature) in running.items():
+                        _collect(key, future, runs, signature)
+                    return converted
+                time.sleep(interval)
+
+        except KeyboardInterrupt:
+            print("\nstopping: waiting for running conversions --------\n")
+            return converted
+
+
+
+
+# %% main ---------------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert Cerca OPM sessions to BIDS as their recordings land.")
+    parser.add_argument("watch_dir", help="share the acquisition PC writes sub-XXX/<prefix>_cMEG_Data folders to")
+    parser.add_argument("--template", required=True,
+                        help="config-bids YAML with the settings shared by all sessions (bids_dir, task, trigger...)")
+    parser.add_argument("--config-dir", required=True, help="where the generated session configs are written")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between polls (default: 30)")
+    parser.add_argument("--settle", type=float, default=60,
+                        help="seconds a recording must be unmodified to count as complete (default: 60)")
+    parser.add_argument("--quiet", type=float, default=10,
+                        help="minutes without a new run before a session is converted (default: 10)")
+    parser.add_argument("--gap", type=float, default=120,
+                        help="minutes between runs that start a new session (default: 120)")
+    parser.add_argument("--retry", type=float, default=60,
+                        help="minutes before a failed session is retried if its runs do not change (default: 60)")
+    parser.add_argument("--workers", type=int, default=2, help="sessions converted at once (default: 2)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes per conversion (default: 1)")
+    parser.add_argument("--once", action="store_true", help="convert what is there now and exit")
+    args = parser.parse_args()
+
+    watch(args.watch_dir, args.template, args.config_dir, interval=args.interval, settle_sec=args.settle,
+          quiet_minutes=args.quiet, gap_minutes=args.gap, retry_minutes=args.retry, n_workers=args.workers,
+          n_jobs=args.jobs, once=args.once)
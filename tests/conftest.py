@@ -0,0 +1,23 @@
+## Test setup: the pipeline scripts (src) and the synthetic recordings (benchmarks) are imported as top-level modules.
+# Harrison Ritz (2025)
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (os.path.join(ROOT, "src"), os.path.join(ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+
+
+@pytest.fixture
+def session(tmp_path):
+    """A small synthetic session (two runs and an empty room) under tmp_path, as a config dict for BidsConfig.from_dict."""
+
+    pytest.importorskip("mne_bids")
+    synthetic_opm = pytest.importorskip("synthetic_opm")
+    return synthetic_opm.make_session(str(tmp_path), n_runs=2, n_channels=8, duration=10.0, n_aux=2)
@@ -0,0 +1,48 @@
+## Catalog: recordings and sessions are indexed incrementally, and their status follows the conversion manifests.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import copy
+
+import pytest
+
+mne = pytest.importorskip("mne")
+yaml = pytest.importorskip("yaml")
+
+import opm_format_bids
+import opm_catalog
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+def test_sessions_of_one_bids_root_index_its_conversions_once(tmp_path, session, monkeypatch):
+    config_dir = tmp_path / "configs"
+    config_dir.mkdir()
+    for task in ("bench", "rest"):
+        cfg_dict = copy.deepcopy(session)
+        cfg_dict["session"]["task"] = task
+        with open(config_dir / f"config-bids_sub-001_task-{task}.yml", 'w') as stream:
+            yaml.safe_dump(cfg_dict, stream)
+    opm_format_bids.bids_conversion(opm_format_bids.set_bids_params(str(config_dir / "config-bids_sub-001_task-bench.yml")))
+
+    db = opm_catalog.connect(str(tmp_path / "catalog.sqlite"))
+    assert opm_catalog.index_recordings(db, session["dirs"]["data_dir"]) == (3, 0)
+    assert opm_catalog.index_recordings(db, session["dirs"]["data_dir"]) == (0, 0)
+
+    bids_dirs = list()
+    index_conversions = opm_catalog.index_conversions
+    monkeypatch.setattr(opm_catalog, "index_conversions",
+                        lambda db, bids_dir: bids_dirs.append(bids_dir) or index_conversions(db, bids_dir))
+    opm_catalog.index_sessions(db, str(config_dir))
+
+    assert bids_dirs == [os.path.abspath(session["dirs"]["bids_dir"])]
+    assert {row["task"]: row["status"] for row in db.execute("SELECT task, status FROM sessions")} \
+        == {"bench": "converted", "rest": "unconverted"}
+    assert {row["status"] for row in db.execute("SELECT status FROM recordings")} == {"converted"}
@@ -0,0 +1,38 @@
+## Config loading and the command line: malformed YAML is reported as INVALID, and no arguments convert the base config.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import pytest
+
+import opm_format_bids
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+@pytest.mark.parametrize("text, message", [
+    ("session: [\n", "while parsing"),
+    ("session: 5\n", "section 'session' must be a mapping"),
+    ("- dirs\n- session\n", "expected a mapping of sections, got list"),
+])
+def test_validate_reports_malformed_configs(tmp_path, capsys, text, message):
+    config_path = tmp_path / "config-bids_sub-001.yml"
+    config_path.write_text(text)
+
+    assert opm_format_bids.main(["validate", "--no-files", str(config_path)]) == 1
+    out = capsys.readouterr().out
+    assert f"INVALID {config_path}" in out
+    assert message in out
+
+
+def test_no_arguments_converts_the_base_config(monkeypatch):
+    converted = list()
+    monkeypatch.setattr(opm_format_bids, "_cmd_convert", lambda args: converted.append(args.config_path) or (None, 0))
+
+    assert opm_format_bids.main([]) == 0
+    assert converted == [""]
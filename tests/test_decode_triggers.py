@@ -0,0 +1,93 @@
+## decode_triggers must match mne.find_events + mne.merge_events, per remapping entry, on random trigger trains.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip("mne")
+
+import opm_format_bids
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _reference(data, sfreq, first_samp, stim_rows, old_ids, new_ids):
+    """The per-channel loop that decode_triggers replaces, sorted by sample as decode_triggers returns."""
+
+    names = [f"STI{ii:03}" for ii in range(len(data))]
+    raw = mne.io.RawArray(data, mne.create_info(names, sfreq, "stim"), first_samp=first_samp, verbose="error")
+    events = [mne.merge_events(mne.find_events(raw, stim_channel=names[row], min_duration=0.001, verbose="error"),
+                               [old], new)
+              for row, old, new in zip(stim_rows, old_ids, new_ids)]
+    events = np.concatenate(events, axis=0)
+    return events[np.argsort(events[:, 0], kind="stable")]
+
+
+def _random_case(rng):
+    sfreq = float(rng.choice([1000., 1200., 2000., 5000.]))
+    n_times, n_stim = int(rng.integers(50, 3000)), int(rng.integers(1, 4))
+    data = np.zeros((n_stim, n_times))
+    for row in range(n_stim):
+        for _ in range(int(rng.integers(0, 12))):
+            onset = int(rng.integers(0, n_times))
+            data[row, onset:onset + int(rng.integers(1, 30))] = rng.integers(1, 6)
+    n_entries = int(rng.integers(1, 5))
+    stim_rows = [int(row) for row in rng.integers(0, n_stim, n_entries)]
+    old_ids = [int(code) for code in rng.integers(1, 6, n_entries)]
+    new_ids = [int(code) for code in rng.integers(10, 20, n_entries)]
+    return data, sfreq, int(rng.integers(0, 1000)), stim_rows, old_ids, new_ids
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+@pytest.mark.parametrize("seed", range(10))
+def test_decode_triggers_matches_find_events(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(300):
+        data, sfreq, first_samp, stim_rows, old_ids, new_ids = _random_case(rng)
+        try:
+            expected = _reference(data, sfreq, first_samp, stim_rows, old_ids, new_ids)
+        except ValueError:  # events closer than shortest_event
+            with pytest.raises(ValueError):
+                opm_format_bids.decode_triggers(data, first_samp, stim_rows, old_ids, new_ids,
+                                                min_samples=0.001 * sfreq)
+            continue
+        events = opm_format_bids.decode_triggers(data, first_samp, stim_rows, old_ids, new_ids,
+                                                 min_samples=0.001 * sfreq)
+        np.testing.assert_array_equal(events, expected)
+
+
+def test_decode_triggers_channel_ending_on_a_trigger():
+    data = np.zeros((2, 100))
+    data[0, 10:20] = 3
+    data[0, 90:] = 4  # still high at the last sample
+    data[1, 50:60] = 2
+
+    events = opm_format_bids.decode_triggers(data, 1000, stim_rows=[0, 1], old_ids=[3, 2], new_ids=[13, 12],
+                                             min_samples=1.0)
+
+    np.testing.assert_array_equal(events, _reference(data, 1000.0, 1000, [0, 1], [3, 2], [13, 12]))
+    assert events[:, 2].tolist() == [13, 12, 4]
+
+
+@pytest.mark.parametrize("description", [np.array(["Trigger 2", "Trigger 3", "Trigger 2"]),             # older mne
+                                         np.array(["Trigger 2", "Trigger 3", "Trigger 2"], dtype=object)])
+def test_rename_annotations_longer_names(description):
+    annotations = SimpleNamespace(description=description)
+
+    opm_format_bids.rename_annotations(annotations, {"Trigger 2": "stimulus/left_visual_field"})
+
+    assert list(annotations.description) == ["stimulus/left_visual_field", "Trigger 3", "stimulus/left_visual_field"]
+    with pytest.raises(ValueError):
+        opm_format_bids.rename_annotations(annotations, {"Trigger 9": "missing"})
@@ -0,0 +1,118 @@
+## Empty rooms: shared sub-emptyroom labels follow the UTC meas_date, and `auto` picks the nearest recording.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import datetime
+import subprocess
+
+import pytest
+
+mne = pytest.importorskip("mne")
+
+import opm_format_bids
+import synthetic_opm
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _add_recording(cfg_dict, prefix, meas_date, trigger_rate=0.0):
+    fn = opm_format_bids._raw_path(cfg_dict["dirs"]["data_dir"], cfg_dict["session"]["ids"], prefix)
+    return synthetic_opm.make_recording(fn, n_channels=8, duration=10.0, trigger_rate=trigger_rate, n_aux=2,
+                                        meas_date=meas_date)
+
+
+def _auto_config(tmp_path, cfg_dict):
+    import yaml
+
+    cfg_dict["session"]["emptyroom_prefix"] = "auto"
+    config_path = tmp_path / "config-bids_sub-001.yml"
+    with open(config_path, 'w') as stream:
+        yaml.safe_dump(cfg_dict, stream)
+    return str(config_path)
+
+
+def _catalog_fns(cfg_dict):
+    return glob.glob(os.path.join(cfg_dict["dirs"]["bids_dir"], "derivatives", "opm_format_bids", "emptyroom_catalog-*.json"))
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+def test_shared_emptyroom_recorded_in_the_evening(session):
+    # 20:00 local time in New York is 01:00 UTC on the next day
+    evening = datetime.datetime(2025, 2, 22, 1, 0, 0, tzinfo=datetime.timezone.utc)
+    fn = _add_recording(session, "20250221_200000", evening)
+    assert opm_format_bids._read_meas_date(fn) == mne.io.read_info(fn, verbose="error")["meas_date"] == evening
+
+    session["session"]["emptyroom_prefix"] = "20250221_200000"
+    session["output"]["shared_emptyroom"] = True
+    cfg = opm_format_bids.BidsConfig.from_dict(session)
+    cfg.validate()
+
+    assert opm_format_bids.bids_conversion(cfg) == ["emptyroom", "task"]
+    assert opm_format_bids._output_paths(cfg)["emptyroom"] == os.path.join(
+        cfg.dirs.bids_dir, "sub-emptyroom", "ses-20250222", "meg", "sub-emptyroom_ses-20250222_task-noise_acq-010000_meg.fif")
+    assert os.path.exists(opm_format_bids._output_paths(cfg)["emptyroom"])
+
+
+def test_preflight_checks_the_emptyroom_date(session, monkeypatch):
+    # a prefix that does not give the date of the recording, in any time zone
+    _add_recording(session, "20250218_120000", datetime.datetime(2025, 2, 22, 1, 0, 0, tzinfo=datetime.timezone.utc))
+    session["session"]["emptyroom_prefix"] = "20250218_120000"
+    session["output"]["shared_emptyroom"] = True
+    cfg = opm_format_bids.BidsConfig.from_dict(session)
+
+    # as for a header without a FIFF_MEAS_DATE tag, whose labels fall back to the prefix
+    monkeypatch.setattr(opm_format_bids, "_read_meas_date", lambda fn: None)
+    with pytest.raises(ValueError, match="ses-20250218 does not match its meas_date"):
+        opm_format_bids.preflight(cfg)
+
+
+def test_auto_selects_the_nearest_emptyroom(tmp_path, session):
+    # the runs start at 15:00 UTC; the session's own empty room is at 14:00
+    utc = datetime.timezone.utc
+    _add_recording(session, "20250221_144500", datetime.datetime(2025, 2, 21, 14, 45, tzinfo=utc))
+    _add_recording(session, "20250221_151500", datetime.datetime(2025, 2, 21, 15, 15, tzinfo=utc), trigger_rate=1.0)
+    _add_recording(session, "20250221_163000", datetime.datetime(2025, 2, 21, 16, 30, tzinfo=utc))
+    config_path = _auto_config(tmp_path, session)
+
+    # a recording with annotations (a run of another session) is not an empty room
+    assert opm_format_bids.set_bids_params(config_path).session.emptyroom_prefix == "20250221_144500"
+
+    # a closer one recorded later is picked up from the updated catalog
+    _add_recording(session, "20250221_145500", datetime.datetime(2025, 2, 21, 14, 55, tzinfo=utc))
+    assert opm_format_bids.set_bids_params(config_path).session.emptyroom_prefix == "20250221_145500"
+
+
+def test_catalog_is_read_only_for_plan_and_covers_only_the_subject(tmp_path, session):
+    config_path = _auto_config(tmp_path, session)
+    other = os.path.join(session["dirs"]["data_dir"], "sub-002", "20250221_140000_cMEG_Data")
+    os.makedirs(other)
+    with open(os.path.join(other, "20250221_140000_meg.fif"), 'w') as stream:
+        stream.write("not a FIF file")
+
+    assert opm_format_bids.main(["plan", config_path]) == 0
+    assert not _catalog_fns(session)
+
+    opm_format_bids.set_bids_params(config_path)
+    (catalog_fn,) = _catalog_fns(session)
+    with open(catalog_fn, 'r') as stream:
+        assert list(json.load(stream)["subjects"]) == ["sub-001"]
+
+    # up to date: selecting again only stats the recordings, without importing mne
+    code = ("import sys, opm_format_bids; opm_format_bids.set_bids_params(sys.argv[1]); "
+            "print('mne' in sys.modules)")
+    result = subprocess.run([sys.executable, "-c", code, config_path], capture_output=True, text=True, check=True,
+                            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    assert result.stdout.strip().splitlines()[-1] == "False"
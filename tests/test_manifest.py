@@ -0,0 +1,63 @@
+## Conversion manifest: unchanged outputs are skipped, changed inputs and settings rewrite only what they affect.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import copy
+
+import pytest
+
+mne = pytest.importorskip("mne")
+
+import opm_format_bids
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _convert(cfg_dict, **changes):
+    cfg_dict = copy.deepcopy(cfg_dict)
+    for section, values in changes.items():
+        cfg_dict[section].update(values)
+    cfg = opm_format_bids.BidsConfig.from_dict(cfg_dict)
+    cfg.validate()
+    return opm_format_bids.bids_conversion(cfg)
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+def test_unchanged_outputs_are_skipped(session):
+    assert _convert(session) == ["emptyroom", "task"]
+    assert _convert(session) == []
+
+    # touched but identical: the content hash still matches
+    run_fn = opm_format_bids._raw_path(session["dirs"]["data_dir"], 1, session["session"]["run_prefix"][1])
+    os.utime(run_fn)
+    assert _convert(session) == []
+
+    # a trigger setting only rewrites the task output, a recording setting also the empty room
+    assert _convert(session, trigger={"event_desc": {"Trigger 2": "rest"}}) == ["task"]
+    assert _convert(session, recording_info={"line_freq": 50.0}) == ["emptyroom", "task"]
+
+
+def test_tasks_of_one_session_keep_their_own_manifest(session):
+    assert _convert(session) == ["emptyroom", "task"]
+    assert _convert(session, session={"task": "rest"}) == ["emptyroom", "task"]
+
+    assert _convert(session) == []
+    assert _convert(session, session={"task": "rest"}) == []
+
+
+def test_emptyroom_ignores_task_only_settings(session):
+    _convert(session, output={"shared_emptyroom": True})
+
+    assert _convert(session, output={"shared_emptyroom": True, "separate_runs": True}) == ["run-01", "run-02"]
+    assert _convert(session, output={"shared_emptyroom": True, "separate_runs": True, "split_size": "1GB"}) \
+        == ["emptyroom", "run-01", "run-02"]
@@ -0,0 +1,98 @@
+## The FIF passthrough must write the same samples as raw.save, and fall back to it when mne's internals change.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import glob
+from unittest import mock
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip("mne")
+mne_bids = pytest.importorskip("mne_bids")
+
+import opm_format_bids
+import synthetic_opm
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _make_runs(root, n_runs=2):
+    return [synthetic_opm.make_recording(os.path.join(root, f"run{rr}_meg.fif"), n_channels=16, duration=30.0,
+                                         trigger_rate=2.0, seed=rr) for rr in range(n_runs)]
+
+
+def _data_bytes(fn):
+    """Sample bytes of every data buffer of a (possibly split) FIF file, in order."""
+
+    raw = mne.io.read_raw_fif(fn, verbose="error")
+    chunks = list()
+    for extra in raw._raw_extras:
+        with open(extra["filename"], "rb") as stream:
+            for ent in extra["ent"]:
+                stream.seek(ent.pos + 16)
+                chunks.append(stream.read(ent.size))
+    return b"".join(chunks)
+
+
+def _config(tmp_path, **output):
+    return opm_format_bids.BidsConfig.from_dict({
+        "dirs": {"data_dir": str(tmp_path), "emptyroom_dir": str(tmp_path), "bids_dir": str(tmp_path / "bids")},
+        "session": {"ids": 1, "task": "test", "session": "01", "run_prefix": ["run0"]},
+        "output": output,
+    })
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+@pytest.mark.parametrize("split_size", ["2GB", "3MB"])
+def test_passthrough_matches_save(tmp_path, split_size):
+    raw = mne.concatenate_raws([mne.io.read_raw_fif(fn, verbose="error") for fn in _make_runs(tmp_path)])
+
+    fnames = opm_format_bids._passthrough_fif(raw, str(tmp_path / "pt_meg.fif"), "single", split_size)
+    raw.save(tmp_path / "ref_meg.fif", fmt="single", split_size=split_size, split_naming="bids", verbose="error")
+    ref_fnames = sorted(glob.glob(str(tmp_path / "ref*_meg.fif")))
+
+    assert fnames is not None
+    assert len(fnames) == len(ref_fnames)
+    assert (len(fnames) > 1) == (split_size == "3MB")
+    assert _data_bytes(fnames[0]) == _data_bytes(ref_fnames[0])
+
+    out, ref = (mne.io.read_raw_fif(fn, verbose="error") for fn in (fnames[0], ref_fnames[0]))
+    assert out.ch_names == ref.ch_names
+    assert (out.first_samp, out.n_times) == (ref.first_samp, ref.n_times)
+    assert list(out.annotations.description) == list(ref.annotations.description)
+    np.testing.assert_array_equal(out.annotations.onset, ref.annotations.onset)
+
+
+def test_passthrough_declines_changed_samples(tmp_path):
+    raw = mne.io.read_raw_fif(_make_runs(tmp_path, n_runs=1)[0], verbose="error")
+
+    assert opm_format_bids._passthrough_fif(raw, str(tmp_path / "pt_meg.fif"), "double", "2GB") is None
+    raw.pick(raw.ch_names[:4])
+    assert opm_format_bids._passthrough_fif(raw, str(tmp_path / "pt_meg.fif"), "single", "2GB") is None
+    assert not os.path.exists(tmp_path / "pt_meg.fif")
+
+
+def test_write_falls_back_when_mne_internals_change(tmp_path, capsys):
+    fn = _make_runs(tmp_path, n_runs=1)[0]
+    raw = mne.io.read_raw_fif(fn, verbose="error")
+    bids_path = mne_bids.BIDSPath(subject="001", session="01", task="test", datatype="meg",
+                                  root=tmp_path / "bids")
+
+    with mock.patch("mne._fiff.utils._make_split_fnames", side_effect=TypeError("changed signature")):
+        opm_format_bids._write_meg_bids(raw, bids_path, _config(tmp_path))
+
+    assert "FIF passthrough failed (TypeError" in capsys.readouterr().out
+    assert "save" not in vars(raw)
+    np.testing.assert_array_equal(mne.io.read_raw_fif(bids_path.fpath, verbose="error").get_data(),
+                                  mne.io.read_raw_fif(fn, verbose="error").get_data())
@@ -0,0 +1,68 @@
+## Output precision: the MEG outputs are written in the requested sample format, within its resolution.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import copy
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip("mne")
+
+import opm_format_bids
+import synthetic_opm
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _convert(cfg_dict, precision):
+    cfg_dict = copy.deepcopy(cfg_dict)
+    cfg_dict["output"]["precision"] = precision
+    cfg = opm_format_bids.BidsConfig.from_dict(cfg_dict)
+    cfg.validate()
+    opm_format_bids.bids_conversion(cfg)
+    return mne.io.read_raw_fif(opm_format_bids._output_paths(cfg)["task"], verbose="error")
+
+
+def _sources(cfg_dict):
+    fns = [opm_format_bids._raw_path(cfg_dict["dirs"]["data_dir"], cfg_dict["session"]["ids"], run)
+           for run in cfg_dict["session"]["run_prefix"]]
+    return mne.concatenate_raws([mne.io.read_raw_fif(fn, verbose="error") for fn in fns])
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+@pytest.mark.parametrize("precision, fmt", [(None, "single"), ("single", "single"), ("double", "double"),
+                                            ("short", "short")])
+def test_outputs_are_written_in_the_requested_precision(session, precision, fmt):
+    out, source = _convert(session, precision), _sources(session)
+    data, expected = out.get_data(), source.get_data()
+
+    assert out.orig_format == fmt
+    stim = mne.pick_types(out.info, meg=False, stim=True)
+    np.testing.assert_array_equal(data[stim], expected[stim])  # trigger codes are stored exactly
+    if fmt == "short":
+        # within one of 2**16 levels spanning each channel's peak (the calibration is stored in float32)
+        resolution = np.abs(expected).max(axis=1, keepdims=True) / 32767
+        assert np.all(np.abs(data - expected) <= 1.01 * resolution)
+    else:
+        np.testing.assert_array_equal(data, expected)
+
+
+def test_runs_of_mixed_formats_are_written_in_double(session):
+    run = session["session"]["run_prefix"][1]
+    synthetic_opm.make_recording(opm_format_bids._raw_path(session["dirs"]["data_dir"], 1, run), n_channels=8,
+                                 duration=10.0, n_aux=2, fmt="double", seed=2)
+
+    out = _convert(session, None)
+
+    assert out.orig_format == "double"
+    np.testing.assert_array_equal(out.get_data(), _sources(session).get_data())
@@ -0,0 +1,78 @@
+## Staged outputs: a failed write leaves nothing in the BIDS root, and conversions of other tasks do not interfere.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import csv
+import copy
+import glob
+import json
+
+import pytest
+
+mne = pytest.importorskip("mne")
+
+import opm_format_bids
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _config(cfg_dict, task="bench"):
+    cfg_dict = copy.deepcopy(cfg_dict)
+    cfg_dict["session"]["task"] = task
+    cfg = opm_format_bids.BidsConfig.from_dict(cfg_dict)
+    cfg.validate()
+    return cfg
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+def test_failed_write_leaves_bids_dir_clean_and_resumes(session, monkeypatch):
+    cfg = _config(session)
+    write_meg_bids = opm_format_bids._write_meg_bids
+
+    def _failing_task_write(raw, bids_path, *args, **kwargs):
+        if bids_path.task != "noise":
+            raise RuntimeError("disk full")
+        return write_meg_bids(raw, bids_path, *args, **kwargs)
+
+    monkeypatch.setattr(opm_format_bids, "_write_meg_bids", _failing_task_write)
+    with pytest.raises(RuntimeError, match="disk full"):
+        opm_format_bids.bids_conversion(cfg)
+
+    meg_dir = os.path.join(cfg.dirs.bids_dir, "sub-001", "ses-01", "meg")
+    assert glob.glob(os.path.join(meg_dir, "*task-noise_meg.fif"))
+    assert not glob.glob(os.path.join(meg_dir, "*task-bench*"))
+    with open(opm_format_bids._manifest_path(cfg), 'r') as stream:
+        assert list(json.load(stream)["outputs"]) == ["emptyroom"]
+
+    monkeypatch.setattr(opm_format_bids, "_write_meg_bids", write_meg_bids)
+    assert opm_format_bids.bids_conversion(cfg) == ["task"]
+
+
+def test_tasks_of_one_session_stage_separately(session):
+    cfg, other = _config(session), _config(session, task="rest")
+
+    root = opm_format_bids._staging_root(cfg, "task")
+    open(os.path.join(root, "in_progress"), 'w').close()
+    assert opm_format_bids._staging_root(other, "task") != root
+    assert os.path.exists(os.path.join(root, "in_progress"))
+
+
+def test_commits_merge_the_session_scans(session):
+    for task in ("bench", "rest"):
+        opm_format_bids.bids_conversion(_config(session, task=task))
+
+    with open(os.path.join(session["dirs"]["bids_dir"], "sub-001", "ses-01", "sub-001_ses-01_scans.tsv"), 'r') as stream:
+        scans = sorted(row["filename"] for row in csv.DictReader(stream, delimiter="\t"))
+    assert scans == ["meg/sub-001_ses-01_task-bench_run-01_meg.fif", "meg/sub-001_ses-01_task-noise_meg.fif",
+                     "meg/sub-001_ses-01_task-rest_run-01_meg.fif"]
+    assert not os.listdir(os.path.join(session["dirs"]["bids_dir"], "derivatives", "opm_format_bids", "staging"))
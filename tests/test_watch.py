@@ -0,0 +1,94 @@
+## Watch folder: recordings are grouped into sessions and converted, and failed sessions are not retried every poll.
+# Harrison Ritz (2025)
+
+
+
+
+# %% import -------------------------------------------------------------------
+
+import os
+import time
+import copy
+
+import pytest
+
+mne = pytest.importorskip("mne")
+yaml = pytest.importorskip("yaml")
+
+import opm_watch
+
+
+
+
+# %% helpers ------------------------------------------------------------------
+
+def _recording(subj, acq_time, n_annotations=10, n_triggers=0, prefix=None):
+    return {"subject": subj, "acq_time": acq_time, "n_annotations": n_annotations, "n_triggers": n_triggers,
+            "error": None, "prefix": prefix or acq_time.replace("-", "").replace(":", "").replace("T", "_"),
+            "mtime": 0.0}
+
+
+def _template(tmp_path, cfg_dict, **trigger):
+    template = {"dirs": {"bids_dir": cfg_dict["dirs"]["bids_dir"]}, "session": {"task": "bench"},
+                "trigger": {**copy.deepcopy(cfg_dict["trigger"]), **trigger}}
+    template["trigger"]["stim_id"] = template["trigger"]["stim_id"][:1]
+    template_path = tmp_path / "template.yml"
+    with open(template_path, 'w') as stream:
+        yaml.safe_dump(template, stream)
+    return str(template_path)
+
+
+
+
+# %% tests --------------------------------------------------------------------
+
+def test_group_sessions():
+    sessions = opm_watch.group_sessions([
+        _recording(4, "2025-02-21T09:00:00"),
+        _recording(4, "2025-02-21T09:20:00", n_annotations=0, n_triggers=12),  # events decoded from stim channels
+        _recording(4, "2025-02-21T08:30:00", n_annotations=0),                 # empty room
+        _recording(4, "2025-02-21T15:00:00"),
+        _recording(4, "2025-02-24T10:00:00"),
+        _recording(5, "2025-02-21T09:05:00"),
+    ], gap_minutes=120)
+
+    assert [(session["subject"], session["session"], session["runs"]) for session in sessions] == [
+        (4, "20250221", ["20250221_090000", "20250221_092000"]),
+        (4, "20250221b", ["20250221_150000"]),
+        (4, "20250224", ["20250224_100000"]),
+        (5, "20250221", ["20250221_090500"]),
+    ]
+
+
+def test_watch_once_converts_the_sessions_it_finds(tmp_path, session):
+    converted = opm_watch.watch(session["dirs"]["data_dir"], _template(tmp_path, session), str(tmp_path / "configs"),
+                                n_workers=1, once=True)
+
+    assert converted == {(1, "20250221"): session["session"]["run_prefix"]}
+    meg_dir = os.path.join(session["dirs"]["bids_dir"], "sub-001", "ses-20250221", "meg")
+    assert sorted(os.listdir(meg_dir))[-1] == "sub-001_ses-20250221_task-noise_meg.json"
+    assert os.path.exists(os.path.join(meg_dir, "sub-001_ses-20250221_task-bench_run-01_meg.fif"))
+
+
+@pytest.mark.parametrize("retry_minutes, retried", [(60, False), (0, True)])
+def test_failed_session_waits_before_it_is_retried(tmp_path, session, monkeypatch, capsys, retry_minutes, retried):
+    # no run is annotated with "Trigger 9", so preflight fails
+    template_path = _template(tmp_path, session, event_desc={"Trigger 9": "missing"})
+    sleep, output = time.sleep, list()
+
+    def _poll(seconds):
+        # stop 20 polls after the first failure
+        output.append(capsys.readouterr().out)
+        failures = [ii for ii, out in enumerate(output) if ": failed in" in out]
+        if (failures and len(output) - failures[0] > 20) or len(output) > 400:
+            raise KeyboardInterrupt
+        sleep(0.05)
+
+    monkeypatch.setattr(opm_watch.time, "sleep", _poll)
+    opm_watch.watch(session["dirs"]["data_dir"], template_path, str(tmp_path / "configs"), interval=0, settle_sec=0,
+                    quiet_minutes=0, retry_minutes=retry_minutes, n_workers=1)
+    output = "".join(output) + capsys.readouterr().out
+
+    assert "sub-001 ses-20250221: failed" in output
+    n_submitted = output.count("converting sub-001 ses-20250221")
+    assert n_submitted > 1 if retried else n_submitted == 1